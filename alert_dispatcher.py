@@ -0,0 +1,167 @@
+import asyncio
+import os
+import random
+import time
+import uuid
+from datetime import datetime
+import httpx
+from http_client import LINE_API_HOST
+
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "1000"))
+ALERT_WORKERS = int(os.getenv("ALERT_WORKERS", "4"))
+ALERT_MAX_RETRIES = int(os.getenv("ALERT_MAX_RETRIES", "3"))
+ALERT_BACKOFF_SECONDS = float(os.getenv("ALERT_BACKOFF_SECONDS", "0.5"))
+LINE_RATE_LIMIT = float(os.getenv("LINE_RATE_LIMIT", "100"))
+LINE_RATE_BURST = int(os.getenv("LINE_RATE_BURST", "20"))
+
+LINE_MULTICAST_URL = f"{LINE_API_HOST}/v2/bot/message/multicast"
+LINE_MULTICAST_MAX = 500
+
+#所有 worker 共用的 token bucket，限制每秒打 LINE API 的次數
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # 排隊依序拿 token，不夠就睡到補滿一個
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # 收到 429 時把 token 扣成負的，之後所有請求一起等 seconds 秒
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+#告警推播：ingest 只負責丟進佇列，背景 worker 查訂閱者並用 multicast 一次推給最多 500 人
+#每一批各自重試，重試仍失敗的那一批寫進 dead letter collection
+class AlertDispatcher:
+    def __init__(self, subscriber_collection, dead_letter_collection, access_token: str,
+                 workers: int = ALERT_WORKERS, queue_size: int = ALERT_QUEUE_SIZE, max_retries: int = ALERT_MAX_RETRIES):
+        self.subscribers = subscriber_collection
+        self.dead_letters = dead_letter_collection
+        self.access_token = access_token
+        self.workers = workers
+        self.max_retries = max_retries
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.bucket = TokenBucket(LINE_RATE_LIMIT, LINE_RATE_BURST)
+        self.stats = {"queued": 0, "dropped": 0, "requests": 0, "sent": 0, "retried": 0, "throttled": 0, "dead_letter": 0}
+        self.client = None
+        self._tasks = []
+
+    def start(self, client: httpx.AsyncClient):
+        self.client = client
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 5):
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"告警佇列未清空，剩餘 {self.queue.qsize()} 筆")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.client = None
+
+    def submit(self, company: str, lab: str, message: str) -> bool:
+        # 不等待，佇列滿就丟棄，避免告警風暴拖慢資料接收
+        try:
+            self.queue.put_nowait({"company": company, "lab": lab, "message": message})
+            self.stats["queued"] += 1
+            return True
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            print(f"告警佇列已滿，丟棄: {company}_{lab}")
+            return False
+
+    async def _worker(self):
+        while True:
+            alert = await self.queue.get()
+            try:
+                await self._deliver(alert)
+            except Exception as e:
+                print(f"告警處理失敗: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, alert: dict):
+        company, lab = alert["company"], alert["lab"]
+        subscribers = await self.subscribers.find(
+            {"company": company, "lab": lab, "line_user_id": {"$exists": True}},
+            {"line_user_id": 1, "lab": 1}
+        ).to_list(None)
+        # 同一個 LINE 帳號可能綁了多筆訂閱，只送一次
+        user_ids = list(dict.fromkeys(sub["line_user_id"] for sub in subscribers if lab in sub["lab"]))
+        chunks = [user_ids[i:i + LINE_MULTICAST_MAX] for i in range(0, len(user_ids), LINE_MULTICAST_MAX)]
+        await asyncio.gather(*[self._multicast(chunk, alert) for chunk in chunks])
+
+    async def _multicast(self, user_ids: list, alert: dict):
+        headers = {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json",
+            # 重試時帶同一個 key，LINE 已收過的會回 409 不會重複發送
+            "X-Line-Retry-Key": str(uuid.uuid4())
+        }
+        payload = {"to": user_ids, "messages": [{"type": "text", "text": alert["message"]}]}
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats["retried"] += 1
+            await self.bucket.acquire()
+            self.stats["requests"] += 1
+            try:
+                resp = await self.client.post(LINE_MULTICAST_URL, headers=headers, json=payload)
+            except httpx.HTTPError as e:
+                error = str(e)
+                await self._backoff(attempt)
+                continue
+            if resp.status_code < 300 or resp.status_code == 409:
+                self.stats["sent"] += len(user_ids)
+                return
+            error = f"{resp.status_code} {resp.text}"
+            if resp.status_code == 429:
+                # 被限流時讓整個 bucket 暫停，其他 worker 也一起等
+                self.stats["throttled"] += 1
+                self.bucket.pause(self._delay(attempt, resp.headers.get("Retry-After")))
+                continue
+            # 5xx 才值得重試，其餘 4xx 直接進 dead letter
+            if resp.status_code < 500:
+                break
+            await self._backoff(attempt, resp.headers.get("Retry-After"))
+
+        self.stats["dead_letter"] += 1
+        print(f"LINE 推播失敗 ({len(user_ids)} 人): {error}")
+        await self.dead_letters.insert_one({
+            "line_user_ids": user_ids,
+            "company": alert["company"],
+            "lab": alert["lab"],
+            "message": alert["message"],
+            "error": error,
+            "created_at": datetime.utcnow()
+        })
+
+    def _delay(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = ALERT_BACKOFF_SECONDS * (2 ** attempt)
+        return delay + random.uniform(0, delay / 2)
+
+    async def _backoff(self, attempt: int, retry_after: str = None):
+        if attempt >= self.max_retries:
+            return
+        await asyncio.sleep(self._delay(attempt, retry_after))
@@ -0,0 +1,79 @@
+import os
+import time
+from typing import Dict, Tuple
+
+ALERT_HYSTERESIS_RATIO = float(os.getenv("ALERT_HYSTERESIS_RATIO", "0.02"))
+ALERT_RENOTIFY_SECONDS = int(os.getenv("ALERT_RENOTIFY_SECONDS", "0"))
+
+#每個 (company_lab, sensor, machine) 底下各 metric 的告警狀態；同一個 frame 可能有多台機台，狀態要分開
+#進入異常時通知一次，持續異常不重複通知 (renotify > 0 時每隔一段時間提醒)，
+#離開異常時送恢復通知；恢復要越過 hysteresis 區間，避免在門檻附近來回跳動
+class AlertStateTracker:
+    def __init__(self, hysteresis_ratio: float = ALERT_HYSTERESIS_RATIO, renotify_seconds: int = ALERT_RENOTIFY_SECONDS):
+        self.hysteresis_ratio = hysteresis_ratio
+        self.renotify_seconds = renotify_seconds
+        self.states: Dict[Tuple[str, str, str], Dict[str, dict]] = {}
+
+    def _band(self, limit: dict, bound: float) -> float:
+        # threshold 可自訂 hysteresis (絕對值)，否則用門檻值的比例
+        if limit.get("hysteresis") is not None:
+            return abs(limit["hysteresis"])
+        return abs(bound) * self.hysteresis_ratio
+
+    def evaluate(self, company_lab: str, sensor: str, machine: str, data: dict, thresholds: dict):
+        fired = {}
+        recovered = {}
+        now = time.monotonic()
+        machine_key = (company_lab, sensor, machine)
+        states = self.states.setdefault(machine_key, {})
+
+        # 門檻值被移除的 metric 不再追蹤
+        for key in [key for key in states if not thresholds.get(key)]:
+            del states[key]
+
+        for key, value in (data or {}).items():
+            limit = thresholds.get(key)
+            if not limit or not isinstance(value, (int, float)):
+                continue
+            minv = limit.get("min")
+            maxv = limit.get("max")
+            state = states.get(key)
+
+            if maxv is not None and value > maxv:
+                level = "high"
+            elif minv is not None and value < minv:
+                level = "low"
+            else:
+                level = None
+
+            if state is None:
+                if level:
+                    states[key] = {"level": level, "notified_at": now}
+                    fired[key] = f"{key} {'過高' if level == 'high' else '過低'} ({value})"
+                continue
+
+            if level and level != state["level"]:
+                # 直接由過高跳到過低 (或反之)
+                states[key] = {"level": level, "notified_at": now}
+                fired[key] = f"{key} {'過高' if level == 'high' else '過低'} ({value})"
+                continue
+
+            if state["level"] == "high":
+                cleared = maxv is None or value <= maxv - self._band(limit, maxv)
+            else:
+                cleared = minv is None or value >= minv + self._band(limit, minv)
+
+            if cleared:
+                del states[key]
+                recovered[key] = f"{key} 恢復正常 ({value})"
+            elif self.renotify_seconds and now - state["notified_at"] >= self.renotify_seconds:
+                state["notified_at"] = now
+                fired[key] = f"{key} 持續{'過高' if state['level'] == 'high' else '過低'} ({value})"
+
+        if not states:
+            del self.states[machine_key]
+        return fired, recovered
+
+    def clear(self, company_lab: str, sensor: str):
+        for machine_key in [k for k in self.states if k[0] == company_lab and k[1] == sensor]:
+            del self.states[machine_key]
@@ -0,0 +1,63 @@
+import argparse
+from contextlib import asynccontextmanager
+import uvicorn
+from bench import fake_motor
+from bench.metrics import LoopLagMonitor, summarize
+
+#壓測用的 server：把 Motor 換成 in-memory 替身後再 import server
+#另外掛上 /bench/stats 與 /bench/reset 讓 loadtest 收集 server 端的數據
+def build_app(latency_ms: float):
+    fake_motor.install(latency_ms)
+    import server
+
+    monitor = LoopLagMonitor()
+    original = server.app.router.lifespan_context
+    # reset 時記下當下的計數，回報時扣掉，只算量測期間
+    baseline = {"ingest": {}, "bus": {}}
+
+    def since(stats, name):
+        if stats is None:
+            return None
+        return {key: value - baseline[name].get(key, 0) if isinstance(value, (int, float)) else value
+                for key, value in stats.items()}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        async with original(app) as state:
+            monitor.start()
+            yield state
+            await monitor.stop()
+
+    server.app.router.lifespan_context = lifespan
+
+    async def stats():
+        return {
+            "inserted": fake_motor.write_stats.inserted,
+            "mongo_write_ms": summarize(fake_motor.write_stats.samples),
+            "event_loop_lag_ms": summarize(monitor.samples),
+            "ingest": since(server.ingest_writer.stats, "ingest"),
+            "bus": since(getattr(server.manager.bus, "stats", None), "bus"),
+            "connections": sum(len(clients) for clients in server.manager.active_connections.values())
+        }
+
+    async def reset():
+        fake_motor.write_stats.reset()
+        monitor.reset()
+        baseline["ingest"] = dict(server.ingest_writer.stats)
+        baseline["bus"] = dict(getattr(server.manager.bus, "stats", None) or {})
+        return {"status": "ok"}
+
+    server.app.add_api_route("/bench/stats", stats, methods=["GET"])
+    server.app.add_api_route("/bench/reset", reset, methods=["POST"])
+    return server.app
+
+if __name__ == "__main__":
+    from run import select_loop, select_http
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mongo-latency-ms", type=float, default=2.0)
+    args = parser.parse_args()
+    uvicorn.run(build_app(args.mongo_latency_ms), host=args.host, port=args.port,
+                loop=select_loop(), http=select_http(), log_level="warning")
@@ -0,0 +1,219 @@
+import asyncio
+import copy
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+from bson import ObjectId
+
+#壓測用的 in-memory Motor 替身，只實作 server 啟動、認證與資料接收會用到的操作
+#insert / bulk_write 可以加上固定延遲來模擬遠端 DB，並記錄每次寫入花的時間
+class WriteStats:
+    def __init__(self):
+        self.latency = 0.0
+        self.reset()
+
+    def reset(self):
+        self.inserted = 0
+        self.samples: List[float] = []
+
+    def record(self, started: float, count: int):
+        self.samples.append((time.perf_counter() - started) * 1000)
+        self.inserted += count
+
+write_stats = WriteStats()
+
+def _get(doc: dict, key: str):
+    for part in key.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, cond in (query or {}).items():
+        value = _get(doc, key)
+        if isinstance(cond, dict) and any(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$gt" and (value is None or not value > arg):
+                    return False
+                if op == "$exists" and (value is not None) != arg:
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+        elif isinstance(value, list) and not isinstance(cond, list):
+            if cond not in value:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+def _apply(doc: dict, update: dict):
+    for key, value in update.get("$set", {}).items():
+        doc[key] = value
+    for key in update.get("$unset", {}):
+        doc.pop(key, None)
+    for key, value in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + value
+
+class FakeCursor:
+    def __init__(self, docs: List[dict]):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        if isinstance(key, list):
+            key, direction = key[0]
+        self.docs.sort(key=lambda d: (_get(d, key) is None, _get(d, key)), reverse=direction < 0)
+        return self
+
+    def limit(self, n: int):
+        if n:
+            self.docs = self.docs[:n]
+        return self
+
+    def skip(self, n: int):
+        self.docs = self.docs[n:]
+        return self
+
+    def batch_size(self, n: int):
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for doc in self.docs:
+            yield doc
+
+    async def next(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+class FakeCollection:
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.docs: List[dict] = []
+
+    async def _delay(self):
+        if write_stats.latency:
+            await asyncio.sleep(write_stats.latency)
+
+    async def insert_one(self, doc: dict):
+        started = time.perf_counter()
+        await self._delay()
+        doc.setdefault("_id", ObjectId())
+        self.docs.append(doc)
+        write_stats.record(started, 1)
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    async def insert_many(self, docs: List[dict], ordered: bool = True):
+        started = time.perf_counter()
+        await self._delay()
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+        self.docs.extend(docs)
+        write_stats.record(started, len(docs))
+        return SimpleNamespace(inserted_ids=[doc["_id"] for doc in docs])
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        started = time.perf_counter()
+        await self._delay()
+        write_stats.record(started, 0)
+        return SimpleNamespace(upserted_count=len(requests), modified_count=0)
+
+    def find(self, query: dict = None, projection: dict = None):
+        return FakeCursor([doc for doc in self.docs if _matches(doc, query)])
+
+    async def find_one(self, query: dict = None, projection: dict = None):
+        for doc in self.docs:
+            if _matches(doc, query):
+                return doc
+        return None
+
+    async def find_one_and_update(self, query: dict, update: dict, **kwargs):
+        doc = await self.find_one(query)
+        if doc is not None:
+            before = copy.deepcopy(doc)
+            _apply(doc, update)
+            return doc if kwargs.get("return_document") else before
+        return None
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        doc = await self.find_one(query)
+        if doc is None and upsert:
+            doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            doc.update(update.get("$setOnInsert", {}))
+            self.docs.append(doc)
+        if doc is not None:
+            _apply(doc, update)
+        return SimpleNamespace(matched_count=int(doc is not None), modified_count=int(doc is not None))
+
+    async def update_many(self, query: dict, update: dict):
+        docs = [doc for doc in self.docs if _matches(doc, query)]
+        for doc in docs:
+            _apply(doc, update)
+        return SimpleNamespace(matched_count=len(docs), modified_count=len(docs))
+
+    async def delete_one(self, query: dict):
+        for i, doc in enumerate(self.docs):
+            if _matches(doc, query):
+                del self.docs[i]
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    async def delete_many(self, query: dict):
+        before = len(self.docs)
+        self.docs = [doc for doc in self.docs if not _matches(doc, query)]
+        return SimpleNamespace(deleted_count=before - len(self.docs))
+
+    async def count_documents(self, query: dict):
+        return sum(1 for doc in self.docs if _matches(doc, query))
+
+    def aggregate(self, pipeline: list, **kwargs):
+        return FakeCursor([])
+
+    async def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        return kwargs.get("name") or "_".join(f"{k}_{d}" for k, d in keys)
+
+    async def drop(self):
+        self.database.collections.pop(self.name, None)
+
+class FakeDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self.collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = FakeCollection(self, name)
+        return collection
+
+    async def list_collection_names(self, filter: dict = None):
+        return [name for name, collection in self.collections.items() if collection.docs and _matches({"name": name}, filter)]
+
+class FakeMotorClient:
+    def __init__(self, *args, **kwargs):
+        self.databases: Dict[str, FakeDatabase] = {}
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase(name)
+        return self.databases[name]
+
+    def close(self):
+        pass
+
+def install(latency_ms: float = 0):
+    # 必須在 import server 之前呼叫
+    import motor.motor_asyncio
+    write_stats.latency = latency_ms / 1000
+    motor.motor_asyncio.AsyncIOMotorClient = FakeMotorClient
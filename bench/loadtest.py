@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from websockets.asyncio.client import connect
+from bench.metrics import summarize
+
+BENCH_KEY = "bench-key"
+BENCH_ACCOUNT = "bench"
+
+#WebSocket 壓測：啟動 bench.app_server (in-memory Mongo)，模擬 N 台機台上傳與 M 個 dashboard 訂閱
+#輸出 JSON，方便不同 commit 之間比較
+def build_parser():
+    parser = argparse.ArgumentParser(description="Load-test WebSocket ingest and broadcast.")
+    parser.add_argument("--machines", type=int, default=20, help="Simulated machine sockets.")
+    parser.add_argument("--dashboards", type=int, default=20, help="Simulated dashboard subscribers.")
+    parser.add_argument("--labs", type=int, default=2, help="company_lab channels the machines and dashboards are spread over.")
+    parser.add_argument("--rate", type=float, default=10, help="Readings per second per machine.")
+    parser.add_argument("--batch", type=int, default=1, help="Readings per frame (uses the batched frame format when > 1).")
+    parser.add_argument("--format", default="json", choices=["json", "msgpack"], help="Machine frame encoding.")
+    parser.add_argument("--duration", type=float, default=10, help="Measured seconds.")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds before measuring starts.")
+    parser.add_argument("--mongo-latency-ms", type=float, default=2.0, help="Simulated insert latency of the Mongo stand-in.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default=None, help="Also write the JSON report to this file.")
+    return parser
+
+class Counters:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.received = 0
+        self.behind = 0
+        self.latencies = []
+
+def setup_env(spool_dir: str):
+    # server 與產生 token 都要用同一組設定
+    os.environ.update({
+        "DATABASE_URL": "bench",
+        "BROADCAST_BACKEND": "memory",
+        "SPOOL_DIR": spool_dir,
+        "SUPERUSER_ACCOUNT": BENCH_ACCOUNT,
+        "SUPERUSER_PASSWORD": BENCH_ACCOUNT,
+    })
+    for key, value in {"JWT_SECRET": "bench-secret", "ALGORITHM": "HS256", "EXPIRE_MINUTES": "60",
+                       "REFRESH_EXPIRE_DAYS": "1", "LINE_CHANNEL_SECRET": "bench"}.items():
+        os.environ.setdefault(key, value)
+
+def encode_frame(fmt: str, frame: dict):
+    if fmt == "msgpack":
+        import msgpack
+        return msgpack.packb(frame)
+    return json.dumps(frame)
+
+async def machine(url: str, name: str, args, counters: Counters, stop: asyncio.Event):
+    subprotocols = [f"iot.{args.format}"] if args.format != "json" else None
+    async with connect(url, subprotocols=subprotocols, max_size=None) as ws:
+        interval = args.batch / args.rate
+        next_at = time.perf_counter() + random.uniform(0, interval)
+        while not stop.is_set():
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -interval:
+                # client 跟不上設定的速率
+                counters.behind += 1
+                next_at = time.perf_counter()
+            next_at += interval
+
+            now = time.time()
+            readings = [{"timestamp": now, "values": {"value": random.random(), "bench_sent": now}} for _ in range(args.batch)]
+            frame = {"machine": name, "readings": readings} if args.batch > 1 else {"machine": name, **readings[0]}
+            await ws.send(encode_frame(args.format, frame))
+            counters.sent += args.batch
+
+async def dashboard(url: str, counters: Counters, ready: asyncio.Event):
+    async with connect(url, max_size=None) as ws:
+        ready.set()
+        async for raw in ws:
+            message = json.loads(raw)
+            counters.received += 1
+            sent = (message.get("values") or {}).get("bench_sent")
+            if sent:
+                counters.latencies.append((time.time() - sent) * 1000)
+
+async def wait_ready(client: httpx.AsyncClient, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"bench server exited with code {process.returncode}")
+        try:
+            resp = await client.get("/bench/stats")
+            if resp.status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("bench server did not start in time")
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args) -> dict:
+    if args.format == "msgpack" and importlib.util.find_spec("msgpack") is None:
+        raise SystemExit("--format msgpack requires the msgpack package")
+
+    spool_dir = tempfile.mkdtemp(prefix="iot-bench-spool-")
+    labs = [f"bench_lab{i}" for i in range(args.labs)]
+    setup_env(spool_dir)
+    os.environ["MACHINE_KEYS"] = json.dumps({lab: BENCH_KEY for lab in labs})
+    from token_utils import create_access_token
+    token = create_access_token({"account": BENCH_ACCOUNT})
+
+    process = subprocess.Popen([sys.executable, "-m", "bench.app_server", "--port", str(args.port),
+                                "--mongo-latency-ms", str(args.mongo_latency_ms)])
+    base = f"ws://127.0.0.1:{args.port}/ws"
+    counters = Counters()
+    stop = asyncio.Event()
+    tasks = []
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}") as client:
+            await wait_ready(client, process)
+
+            # dashboard 先連上，確保量測期間的廣播都收得到
+            readies = []
+            for i in range(args.dashboards):
+                ready = asyncio.Event()
+                readies.append(ready)
+                url = f"{base}/{labs[i % len(labs)]}?sensor=bench&token={token}"
+                tasks.append(asyncio.create_task(dashboard(url, counters, ready)))
+            await asyncio.wait_for(asyncio.gather(*[ready.wait() for ready in readies]), 30)
+
+            for i in range(args.machines):
+                url = f"{base}/{labs[i % len(labs)]}?sensor=bench&api_key={BENCH_KEY}"
+                tasks.append(asyncio.create_task(machine(url, f"m{i}", args, counters, stop)))
+
+            await asyncio.sleep(args.warmup)
+            await client.post("/bench/reset")
+            counters.reset()
+            started = time.perf_counter()
+            await asyncio.sleep(args.duration)
+            elapsed = time.perf_counter() - started
+            sent, received, latencies, behind = counters.sent, counters.received, counters.latencies, counters.behind
+            server_stats = (await client.get("/bench/stats")).json()
+            stop.set()
+
+        # 每筆資料會送到同一個 company_lab 的所有 dashboard
+        fanout = sum(len(range(i, args.machines, len(labs))) * len(range(i, args.dashboards, len(labs)))
+                     for i in range(len(labs))) / max(1, args.machines)
+        failed = [task.exception() for task in tasks if task.done() and not task.cancelled() and task.exception()]
+        return {
+            "commit": git_commit(),
+            "config": vars(args),
+            "elapsed_s": round(elapsed, 3),
+            "ingest": {
+                "sent": sent,
+                "sent_per_sec": round(sent / elapsed, 1),
+                "inserted": server_stats["inserted"],
+                "inserted_per_sec": round(server_stats["inserted"] / elapsed, 1),
+                "client_behind": behind,
+                "writer": server_stats["ingest"]
+            },
+            "broadcast": {
+                "received": received,
+                "received_per_sec": round(received / elapsed, 1),
+                "expected": round(sent * fanout),
+                "latency_ms": summarize(latencies)
+            },
+            "mongo_write_ms": server_stats["mongo_write_ms"],
+            "event_loop_lag_ms": server_stats["event_loop_lag_ms"],
+            "client_errors": [repr(e) for e in failed[:10]]
+        }
+    finally:
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
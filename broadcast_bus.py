@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import os
+from typing import Callable, Dict, Set
+
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "memory")
+BROADCAST_SOCKET = os.getenv("BROADCAST_SOCKET", "/tmp/iot-backend-bus.sock")
+BROKER_MAX_BUFFER = int(os.getenv("BROKER_MAX_BUFFER", str(8 * 2 ** 20)))
+BUS_SEND_QUEUE_SIZE = int(os.getenv("BUS_SEND_QUEUE_SIZE", "10000"))
+
+#廣播的 pub/sub 後端
+#協定 (一行一個 frame，以 tab 分隔)：
+#  S\t<channel>          訂閱
+#  U\t<channel>          取消訂閱
+#  P\t<channel>\t<json>  發佈，broker 轉給所有訂閱該 channel 的連線 (包含自己)
+
+#單一 process：直接交給本地 ConnectionManager
+class InProcessBus:
+    local = True
+
+    def __init__(self):
+        self.handler: Callable[[str, str], None] = None
+
+    async def start(self, handler: Callable[[str, str], None]):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    def subscribe(self, channel: str):
+        pass
+
+    def unsubscribe(self, channel: str):
+        pass
+
+    async def publish(self, channel: str, text: str):
+        if self.handler:
+            self.handler(channel, text)
+
+#多個 worker：透過 Unix domain socket 連到共用的 broker process
+#publish 只放進有上限的佇列，由背景 sender 寫出；broker 卡住時丟掉最舊的，不拖慢資料接收
+class UnixSocketBus:
+    local = False
+
+    def __init__(self, path: str = BROADCAST_SOCKET, queue_size: int = BUS_SEND_QUEUE_SIZE):
+        self.path = path
+        self.handler: Callable[[str, str], None] = None
+        self.channels: Set[str] = set()
+        self.reader = None
+        self.writer = None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.stats = {"published": 0, "received": 0, "local_fallback": 0, "reconnects": 0, "dropped": 0}
+        self._tasks = []
+
+    async def start(self, handler: Callable[[str, str], None]):
+        self.handler = handler
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._sender())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._close_writer()
+
+    def subscribe(self, channel: str):
+        self.channels.add(channel)
+        self._send(f"S\t{channel}\n")
+
+    def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+        self._send(f"U\t{channel}\n")
+
+    async def publish(self, channel: str, text: str):
+        if self.writer is None:
+            self._deliver_local(channel, text)
+            return
+        if self.queue.full():
+            # 和 client 佇列一樣丟掉最舊的一筆，只保留最新資料
+            self.queue.get_nowait()
+            self.stats["dropped"] += 1
+        self.queue.put_nowait((channel, text))
+
+    def _deliver_local(self, channel: str, text: str):
+        # broker 斷線時至少送給本 process 的 dashboard
+        self.stats["local_fallback"] += 1
+        if self.handler and channel in self.channels:
+            self.handler(channel, text)
+
+    async def _sender(self):
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if self.writer is None:
+                for channel, text in batch:
+                    self._deliver_local(channel, text)
+                continue
+            self._send("".join(f"P\t{channel}\t{text}\n" for channel, text in batch))
+            self.stats["published"] += len(batch)
+            writer = self.writer
+            if writer is None:
+                continue
+            try:
+                await writer.drain()
+            except Exception:
+                if writer is self.writer:
+                    self._close_writer()
+
+    def _send(self, line: str):
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(line.encode("utf-8"))
+        except Exception:
+            self._close_writer()
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=2 ** 20)
+                delay = 0.5
+                for channel in self.channels:
+                    self._send(f"S\t{channel}\n")
+                while True:
+                    line = await self.reader.readline()
+                    if not line:
+                        break
+                    _, channel, text = line.decode("utf-8").rstrip("\n").split("\t", 2)
+                    self.stats["received"] += 1
+                    if self.handler:
+                        self.handler(channel, text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"廣播 broker 連線失敗 ({self.path}): {e}")
+            self._close_writer()
+            self.stats["reconnects"] += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+def create_bus():
+    if BROADCAST_BACKEND == "unix":
+        return UnixSocketBus(BROADCAST_SOCKET)
+    return InProcessBus()
+
+#broker：記錄每條連線訂閱的 channel，收到 P 就轉發
+async def run_broker(path: str = BROADCAST_SOCKET):
+    subscriptions: Dict[asyncio.StreamWriter, Set[str]] = {}
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels = subscriptions[writer] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                kind, rest = line.decode("utf-8").rstrip("\n").split("\t", 1)
+                if kind == "S":
+                    channels.add(rest)
+                elif kind == "U":
+                    channels.discard(rest)
+                elif kind == "P":
+                    channel = rest.split("\t", 1)[0]
+                    for peer, peer_channels in list(subscriptions.items()):
+                        # 對方太慢就丟掉，不讓 broker 記憶體無限成長
+                        if channel in peer_channels and peer.transport.get_write_buffer_size() < BROKER_MAX_BUFFER:
+                            peer.write(line)
+        except Exception as e:
+            print(f"broker 連線錯誤: {e}")
+        finally:
+            subscriptions.pop(writer, None)
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    # socket 只給同一個使用者連，避免其他本機使用者注入廣播
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle, path, limit=2 ** 20)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0o600)
+    print(f"廣播 broker 啟動於 {path}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the broadcast broker for multi-worker deployments.")
+    parser.add_argument("--socket", default=BROADCAST_SOCKET, help="Unix domain socket path.")
+    args = parser.parse_args()
+    asyncio.run(run_broker(args.socket))
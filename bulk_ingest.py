@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Tuple
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from machine_frames import parse_timestamp
+
+BULK_INGEST_BATCH_SIZE = int(os.getenv("BULK_INGEST_BATCH_SIZE", "1000"))
+BULK_INGEST_MAX_LINE = int(os.getenv("BULK_INGEST_MAX_LINE", str(1024 * 1024)))
+BULK_INGEST_MAX_ERRORS = int(os.getenv("BULK_INGEST_MAX_ERRORS", "100"))
+INFLATE_CHUNK = 64 * 1024
+DUPLICATE_KEY = 11000
+
+#串流解壓 + 切行：不把整個檔案讀進記憶體
+#gzip / zlib 自動判斷，多個 gzip 串在一起 (cat a.gz b.gz) 也可以
+async def iter_ndjson_lines(chunks: AsyncIterator[bytes], compressed: bool) -> AsyncIterator[Tuple[int, bytes]]:
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32) if compressed else None
+    buffer = b""
+    line_no = 0
+
+    def inflate(data: bytes):
+        nonlocal decompressor
+        while data:
+            # 限制每次解壓的大小，避免壓縮炸彈一次吃光記憶體
+            try:
+                out = decompressor.decompress(data, INFLATE_CHUNK)
+            except zlib.error as e:
+                raise ValueError(f"gzip 解壓失敗: {e}")
+            yield out
+            data = decompressor.unconsumed_tail
+            if decompressor.eof:
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+    async for chunk in chunks:
+        for data in (inflate(chunk) if decompressor else (chunk,)):
+            buffer += data
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                line_no += 1
+                if line.strip():
+                    yield line_no, line
+            if len(buffer) > BULK_INGEST_MAX_LINE:
+                raise ValueError(f"第 {line_no + 1} 行超過 {BULK_INGEST_MAX_LINE} bytes")
+
+    if decompressor and not decompressor.eof:
+        raise ValueError("gzip 資料不完整")
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+#_id 由 machine + timestamp + values 決定：同一份檔案重傳只會撞 duplicate key，不會重複寫入
+#前 4 bytes 和一般 ObjectId 一樣是秒數，依 _id 排序仍大致照時間
+def reading_id(machine: str, timestamp: datetime, values: dict) -> ObjectId:
+    seconds = int(timestamp.replace(tzinfo=timezone.utc).timestamp()) & 0xFFFFFFFF
+    digest = hashlib.blake2b(
+        json.dumps([machine, timestamp.isoformat(), values], sort_keys=True, default=str).encode(),
+        digest_size=8
+    ).digest()
+    return ObjectId(struct.pack(">I", seconds) + digest)
+
+#一行 NDJSON 轉成 doc，格式或 timestamp 不對丟 ValueError
+def parse_line(line: bytes, model) -> dict:
+    try:
+        reading = model.model_validate_json(line)
+    except ValidationError as e:
+        raise ValueError(e.errors()[0]["msg"])
+    timestamp = parse_timestamp(reading.timestamp, strict=True)
+    return {
+        "_id": reading_id(reading.machine, timestamp, reading.values),
+        "timestamp": timestamp,
+        "machine": reading.machine,
+        "values": reading.values
+    }
+
+#補資料用：依每筆自己的 timestamp 分到月份 collection，滿 batch 就 unordered insert_many
+#每筆拒絕的原因 (行號) 都會回報，成功寫入的才更新 rollup
+class BulkIngest:
+    def __init__(self, db, index_manager=None, catalog=None, rollup_writer=None, batch_size: int = BULK_INGEST_BATCH_SIZE):
+        self.db = db
+        self.index_manager = index_manager
+        self.catalog = catalog
+        self.rollup_writer = rollup_writer
+        self.batch_size = batch_size
+        self.buffers: Dict[str, List[Tuple[int, dict]]] = {}
+        self.collections: Dict[str, int] = {}
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors: List[dict] = []
+        self.started = time.perf_counter()
+        self.write_seconds = 0.0
+
+    def reject(self, line_no: int, error: str):
+        self.rejected += 1
+        if len(self.errors) < BULK_INGEST_MAX_ERRORS:
+            self.errors.append({"line": line_no, "error": error})
+
+    async def add(self, company_lab: str, line_no: int, doc: dict):
+        timestamp = doc["timestamp"]
+        collection_name = f"{company_lab}-{doc['machine']}-{timestamp.year}-{timestamp.month}"
+        buf = self.buffers.setdefault(collection_name, [])
+        buf.append((line_no, doc))
+        if len(buf) >= self.batch_size:
+            await self._write(company_lab, collection_name, self.buffers.pop(collection_name))
+
+    async def finish(self, company_lab: str) -> dict:
+        buffers, self.buffers = self.buffers, {}
+        await asyncio.gather(*[self._write(company_lab, name, rows) for name, rows in buffers.items()])
+        elapsed = time.perf_counter() - self.started
+        return {
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "collections": self.collections,
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "write_ms": round(self.write_seconds * 1000, 1),
+            "rows_per_sec": round((self.accepted + self.rejected) / elapsed, 1) if elapsed else 0,
+            "errors": self.errors
+        }
+
+    async def _write(self, company_lab: str, collection_name: str, rows: List[Tuple[int, dict]]):
+        if self.index_manager:
+            try:
+                await self.index_manager.ensure_timestamp_index(collection_name)
+            except Exception as e:
+                print(f"建立 timestamp 索引失敗 ({collection_name}): {e}")
+
+        docs = [doc for _, doc in rows]
+        failed = {}
+        duplicates = set()
+        started = time.perf_counter()
+        try:
+            await self.db[collection_name].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                if err.get("code") == DUPLICATE_KEY:
+                    # 之前已經傳過 (重傳)，資料已經在 DB
+                    duplicates.add(err["index"])
+                else:
+                    failed[err["index"]] = err.get("errmsg", "寫入失敗")
+        except Exception as e:
+            # timeout 等錯誤可能已經部分寫入：回報失敗讓 client 重傳，重傳時靠 _id 去重
+            # 已寫入的那些之後只會撞 duplicate key，不會算進 rollup，所以這段記成 gap
+            failed = {i: str(e) for i in range(len(docs))}
+            if self.rollup_writer:
+                timestamps = [doc["timestamp"] for doc in docs]
+                self.rollup_writer.add_gap(company_lab, docs[0]["machine"], min(timestamps), max(timestamps))
+        finally:
+            self.write_seconds += time.perf_counter() - started
+
+        for i, (line_no, doc) in enumerate(rows):
+            if i in failed:
+                self.reject(line_no, failed[i])
+                continue
+            if i in duplicates:
+                self.duplicates += 1
+                continue
+            self.accepted += 1
+            self.collections[collection_name] = self.collections.get(collection_name, 0) + 1
+            if self.rollup_writer:
+                self.rollup_writer.add(company_lab, doc["machine"], doc["timestamp"], doc["values"])
+        if len(failed) + len(duplicates) < len(rows) and self.catalog:
+            self.catalog.add(collection_name)
@@ -0,0 +1,72 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import Set
+from index_manager import SENSOR_COLLECTION_PATTERN
+
+CATALOG_REFRESH_SECONDS = int(os.getenv("CATALOG_REFRESH_SECONDS", "60"))
+
+#collection 名稱目錄：啟動時載入一次，ingest 建立新月份 collection 時更新，背景定期重新整理
+#其他 worker 建立的 collection 最多延遲 CATALOG_REFRESH_SECONDS 才會出現在目錄裡，
+#所以本月 / 上個月查不到時直接問 DB，避免跨月時查詢漏掉新的月份
+class CollectionCatalog:
+    def __init__(self, db, refresh_seconds: int = CATALOG_REFRESH_SECONDS):
+        self.db = db
+        self.refresh_seconds = refresh_seconds
+        self.names: Set[str] = set()
+        self._added: Set[str] = set()
+        self._task = None
+
+    async def load(self):
+        self._added = set()
+        names = set(await self.db.list_collection_names())
+        # 查詢期間 ingest 新增的 collection 不要被舊的清單蓋掉
+        self.names = names | self._added
+
+    def _month(self, name: str):
+        # {company_lab}-{machine}-{year}-{month} -> (year, month)
+        if not SENSOR_COLLECTION_PATTERN.match(name):
+            return None
+        _, year, month = name.rsplit("-", 2)
+        return int(year), int(month)
+
+    def add(self, name: str):
+        if name in self.names:
+            return
+        self.names.add(name)
+        self._added.add(name)
+
+    async def exists(self, name: str) -> bool:
+        if name in self.names:
+            return True
+        month = self._month(name)
+        now = datetime.utcnow()
+        recent = {(now.year, now.month), (now.year, now.month - 1) if now.month > 1 else (now.year - 1, 12)}
+        if month not in recent:
+            return False
+        # 本月 / 上個月可能是別的 worker 剛建立的，目錄還沒更新
+        if await self.db.list_collection_names(filter={"name": name}):
+            self.add(name)
+            return True
+        return False
+
+    def start(self):
+        if self.refresh_seconds > 0 and self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.load()
+            except Exception as e:
+                print(f"collection 目錄更新失敗: {e}")
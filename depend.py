@@ -1,6 +1,7 @@
 from fastapi import Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from token_utils import decode_access_token
+from user_cache import user_cache
 
 security = HTTPBearer()
 
@@ -8,3 +9,6 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     token = credentials.credentials
     payload = decode_access_token(token)
     return payload
+
+async def get_current_account(auth=Depends(get_current_user)):
+    return await user_cache.get(auth["account"])
@@ -0,0 +1,179 @@
+import csv
+import io
+import json
+import zipfile
+from datetime import datetime
+from typing import AsyncIterator, List
+from xml.sax.saxutils import escape
+
+EXPORT_HEADERS = ["timestamp", "machine", "temperature", "humidity", "pm25", "pm10",
+                  "pm25_average", "pm10_average", "co2", "tvoc"]
+EXPORT_CHUNK_ROWS = 1000
+XLSX_MAX_ROWS = 1048576
+
+MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+def format_timestamp(ts):
+    return ts.strftime("%Y-%m-%d %H:%M:%S") if isinstance(ts, datetime) else ts
+
+def doc_to_row(doc: dict) -> list:
+    values = doc.get("values", {})
+    return [format_timestamp(doc["timestamp"]), doc.get("machine", "")] + [values.get(key, "") for key in EXPORT_HEADERS[2:]]
+
+#CSV：每累積一批 row 就送出
+async def stream_csv(docs: AsyncIterator[dict]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # 加 BOM，Excel 開啟時中文才不會亂碼
+    buffer.write("\ufeff")
+    writer.writerow(EXPORT_HEADERS)
+    rows = 0
+    async for doc in docs:
+        writer.writerow(doc_to_row(doc))
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+async def stream_ndjson(docs: AsyncIterator[dict]):
+    lines = []
+    async for doc in docs:
+        lines.append(json.dumps({
+            "timestamp": format_timestamp(doc["timestamp"]),
+            "machine": doc.get("machine", ""),
+            "values": doc.get("values", {})
+        }, ensure_ascii=False, default=str))
+        if len(lines) >= EXPORT_CHUNK_ROWS:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+#XLSX：自己組 SpreadsheetML，zip 寫進不可 seek 的 sink，邊寫邊送
+#(openpyxl 即使 write-only 也要整份存完才能輸出)
+class _ChunkSink:
+    def __init__(self):
+        self.parts: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def _xlsx_cell(value) -> str:
+    if value == "" or value is None:
+        return "<c/>"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f"<c><v>{value}</v></c>"
+    return f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>'
+
+def _xlsx_row(values: list) -> str:
+    return "<row>" + "".join(_xlsx_cell(v) for v in values) + "</row>"
+
+SHEET_HEAD = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+              '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+SHEET_TAIL = "</sheetData></worksheet>"
+
+def _xlsx_workbook_parts(sheet_names: List[str]):
+    sheets = "".join(
+        f'<sheet name="{escape(name)}" sheetId="{i}" r:id="rId{i}"/>' for i, name in enumerate(sheet_names, 1)
+    )
+    rels = "".join(
+        f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{i}.xml"/>'
+        for i in range(1, len(sheet_names) + 1)
+    )
+    overrides = "".join(
+        f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for i in range(1, len(sheet_names) + 1)
+    )
+    return {
+        "[Content_Types].xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f'{overrides}</Types>'
+        ),
+        "_rels/.rels": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ),
+        "xl/workbook.xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheets}</sheets></workbook>'
+        ),
+        "xl/_rels/workbook.xml.rels": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{rels}</Relationships>'
+        ),
+    }
+
+async def stream_xlsx(docs: AsyncIterator[dict], title: str = "SensorData"):
+    sink = _ChunkSink()
+    zf = zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED)
+    sheet_names = []
+    sheet = None
+    sheet_rows = 0
+    pending = []
+
+    def open_sheet():
+        nonlocal sheet, sheet_rows
+        sheet_names.append(title if not sheet_names else f"{title}{len(sheet_names) + 1}")
+        sheet = zf.open(f"xl/worksheets/sheet{len(sheet_names)}.xml", "w", force_zip64=True)
+        sheet.write(SHEET_HEAD.encode("utf-8"))
+        sheet.write(_xlsx_row(EXPORT_HEADERS).encode("utf-8"))
+        sheet_rows = 1
+
+    def write_pending():
+        if pending:
+            sheet.write("".join(pending).encode("utf-8"))
+            pending.clear()
+
+    open_sheet()
+    async for doc in docs:
+        if sheet_rows >= XLSX_MAX_ROWS:
+            # 超過單一工作表列數上限就換下一張
+            write_pending()
+            sheet.write(SHEET_TAIL.encode("utf-8"))
+            sheet.close()
+            open_sheet()
+        pending.append(_xlsx_row(doc_to_row(doc)))
+        sheet_rows += 1
+        if len(pending) >= EXPORT_CHUNK_ROWS:
+            write_pending()
+            data = sink.drain()
+            if data:
+                yield data
+
+    write_pending()
+    sheet.write(SHEET_TAIL.encode("utf-8"))
+    sheet.close()
+    for name, content in _xlsx_workbook_parts(sheet_names).items():
+        zf.writestr(name, content)
+    zf.close()
+    yield sink.drain()
+
+EXPORTERS = {
+    "xlsx": stream_xlsx,
+    "csv": stream_csv,
+    "ndjson": stream_ndjson,
+}
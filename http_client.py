@@ -0,0 +1,38 @@
+import importlib.util
+import os
+import httpx
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+LINE_MAX_CONNECTIONS = int(os.getenv("LINE_MAX_CONNECTIONS", "20"))
+
+#可以指到本機的 line_stub.py 做離線測試
+LINE_API_HOST = os.getenv("LINE_API_BASE", "https://api.line.me").rstrip("/")
+
+def _transport(max_connections: int, http2: bool) -> httpx.AsyncHTTPTransport:
+    # retries 只重試連線失敗 (請求還沒送出)，POST 也不會重複執行
+    return httpx.AsyncHTTPTransport(
+        http2=http2,
+        retries=HTTP_RETRIES,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(HTTP_MAX_KEEPALIVE, max_connections),
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+
+#整個 process 共用一個 AsyncClient (在 lifespan 建立/關閉)
+#LINE 有自己的連線池與上限，其餘 (機台控制) 走預設連線池
+def create_http_client() -> httpx.AsyncClient:
+    http2 = importlib.util.find_spec("h2") is not None
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        mounts={
+            LINE_API_HOST: _transport(LINE_MAX_CONNECTIONS, http2),
+            "all://": _transport(HTTP_MAX_CONNECTIONS, http2),
+        }
+    )
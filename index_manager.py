@@ -0,0 +1,91 @@
+import asyncio
+import re
+from typing import Dict, Set
+
+#每月感測資料 collection 的名稱：{company_lab}-{machine}-{year}-{month}
+SENSOR_COLLECTION_PATTERN = re.compile(r"^.+-.+-\d{4}-\d{1,2}$")
+
+#metadata collection 需要的索引：collection -> [(keys, options)]
+METADATA_INDEXES = {
+    "user": [
+        ([("account", 1)], {"unique": True}),
+    ],
+    "thresholds": [
+        ([("company", 1), ("lab", 1), ("sensor", 1)], {"unique": True}),
+    ],
+    "line_subscriber": [
+        ([("binding_code", 1)], {"sparse": True}),
+        ([("account", 1)], {"unique": True}),
+    ],
+    "rollup_1m": [
+        ([("company_lab", 1), ("machine", 1), ("bucket", 1)], {"unique": True}),
+    ],
+    "rollup_1h": [
+        ([("company_lab", 1), ("machine", 1), ("bucket", 1)], {"unique": True}),
+    ],
+    "rollup_state": [
+        ([("company_lab", 1), ("machine", 1)], {"unique": True}),
+    ],
+    "rollup_gaps": [
+        ([("company_lab", 1), ("machine", 1), ("start", 1)], {}),
+    ],
+    "refresh_tokens": [
+        ([("jti", 1)], {"unique": True}),
+        ([("account", 1), ("revoked", 1)], {}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+}
+
+class IndexManager:
+    def __init__(self, db):
+        self.db = db
+        self.known_collections: Set[str] = set()
+        self.report: Dict[str, str] = {}
+        self._task = None
+
+    async def ensure_metadata_indexes(self):
+        for collection_name, indexes in METADATA_INDEXES.items():
+            for keys, options in indexes:
+                label = f"{collection_name}." + "_".join(k for k, _ in keys)
+                try:
+                    name = await self.db[collection_name].create_index(keys, **options)
+                    self.report[label] = f"ok ({name})"
+                except Exception as e:
+                    # 例如既有資料重複導致 unique 索引建立失敗，只回報不中斷啟動
+                    self.report[label] = f"failed: {e}"
+
+    async def ensure_timestamp_index(self, collection_name: str):
+        if collection_name in self.known_collections:
+            return
+        await self.db[collection_name].create_index([("timestamp", 1)])
+        self.known_collections.add(collection_name)
+
+    async def verify_sensor_collections(self, collection_names=None):
+        if collection_names is None:
+            collection_names = await self.db.list_collection_names()
+        names = [n for n in collection_names if SENSOR_COLLECTION_PATTERN.match(n)]
+        failed = 0
+        for name in names:
+            try:
+                await self.ensure_timestamp_index(name)
+            except Exception as e:
+                failed += 1
+                print(f"建立 timestamp 索引失敗 ({name}): {e}")
+        self.report["sensor.timestamp"] = f"ok ({len(names) - failed}/{len(names)} collections)"
+        print(f"索引檢查: sensor.timestamp {self.report['sensor.timestamp']}")
+
+    async def startup(self, collection_names=None):
+        await self.ensure_metadata_indexes()
+        for label, status in self.report.items():
+            print(f"索引檢查: {label} {status}")
+        # 月份 collection 可能很多，放背景處理不拖慢啟動
+        self._task = asyncio.create_task(self.verify_sensor_collections(collection_names))
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import bson
+
+# Windows 沒有 fcntl，只能單一 worker 使用
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))
+SPOOL_MAX_STAGED = int(os.getenv("SPOOL_MAX_STAGED", "50000"))
+SPOOL_FLUSH_MS = int(os.getenv("SPOOL_FLUSH_MS", "100"))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", "1000"))
+SPOOL_RETRY_SECONDS = float(os.getenv("SPOOL_RETRY_SECONDS", "5"))
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "true").lower() == "true"
+SPOOL_MAX_SLOTS = 64
+
+# 每筆紀錄: 長度 + crc32 + BSON({"c": collection, "d": doc})
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+OFFSET_FILE = "offset.json"
+
+#MongoDB 慢或掛掉時的本機落地佇列：分段的 append-only 檔案
+#讀取位置 (segment, position) 寫 temp 檔再 os.replace，當機也不會寫壞
+#背景 replayer 等 DB 恢復後用 insert_many 補寫回月份 collection；doc 都有 _id，重複補寫只會撞 duplicate key
+class IngestSpool:
+    def __init__(self, directory: str = SPOOL_DIR, segment_bytes: int = SPOOL_SEGMENT_BYTES, max_bytes: int = SPOOL_MAX_BYTES,
+                 max_staged: int = SPOOL_MAX_STAGED, replay_batch: int = SPOOL_REPLAY_BATCH):
+        self.root = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_staged = max_staged
+        self.replay_batch = replay_batch
+        self.directory = None
+        self.sink: Optional[Callable[[str, List[dict]], Awaitable[None]]] = None
+        self.staged: List[Tuple[str, dict]] = []
+        self.segments: Dict[int, int] = {}
+        self.active = None
+        self.active_seq = 0
+        self.offset = (0, 0)
+        self.healthy = True
+        self.retry_at = 0.0
+        self.stats = {"depth_bytes": 0, "segments": 0, "staged": 0, "spooled": 0, "replayed": 0,
+                      "dropped": 0, "corrupted": 0, "replay_rate": 0.0}
+        self._replay_window = deque()
+        self._lock_file = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    def start(self, sink: Callable[[str, List[dict]], Awaitable[None]]):
+        self.sink = sink
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # 關機時不再補寫，只把暫存的紀錄落地
+        self._closing = True
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self._flush_staged()
+        if self.active:
+            self.active.close()
+            self.active = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def put(self, collection_name: str, docs: List[dict]) -> bool:
+        # 只放進記憶體，由背景 task 批次寫檔；空間不夠回 False 讓呼叫端自己處理
+        if self._closing and self.active is None:
+            return False
+        if len(self.staged) + len(docs) > self.max_staged or self.stats["depth_bytes"] >= self.max_bytes:
+            return False
+        self.staged.extend((collection_name, doc) for doc in docs)
+        self.stats["staged"] = len(self.staged)
+        self._wakeup.set()
+        return True
+
+    def mark_unhealthy(self):
+        # 寫入失敗後先全部走 spool，過 SPOOL_RETRY_SECONDS 再由 replayer 試探
+        self.healthy = False
+        self.retry_at = time.monotonic() + SPOOL_RETRY_SECONDS
+
+    async def _run(self):
+        try:
+            await asyncio.to_thread(self._open)
+        except Exception as e:
+            print(f"開啟 spool 失敗 ({self.root}): {e}")
+            self._closing = True
+            return
+
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), SPOOL_FLUSH_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush_staged()
+
+            if self.stats["depth_bytes"] and time.monotonic() >= self.retry_at:
+                try:
+                    if await self._replay():
+                        # 還有資料就馬上接著補寫
+                        self._wakeup.set()
+                except Exception as e:
+                    print(f"spool 補寫失敗，{SPOOL_RETRY_SECONDS} 秒後重試: {e}")
+                    self.mark_unhealthy()
+            self._update_rate()
+
+    async def _flush_staged(self):
+        if not self.staged or self.directory is None:
+            return
+        records, self.staged = self.staged, []
+        self.stats["staged"] = 0
+        try:
+            written = await asyncio.to_thread(self._append, records)
+        except Exception as e:
+            written = 0
+            print(f"寫入 spool 失敗: {e}")
+        self.stats["spooled"] += written
+        if written < len(records):
+            self.stats["dropped"] += len(records) - written
+            print(f"spool 空間不足，丟棄 {len(records) - written} 筆")
+
+    async def _replay(self) -> int:
+        records, offset = await asyncio.to_thread(self._read, self.replay_batch)
+        if records:
+            groups: Dict[str, List[dict]] = {}
+            for collection_name, doc in records:
+                groups.setdefault(collection_name, []).append(doc)
+            # 任一 collection 失敗就不推進 offset，下次整批重送
+            await asyncio.gather(*[self.sink(name, docs) for name, docs in groups.items()])
+            self.stats["replayed"] += len(records)
+            self._replay_window.append((time.monotonic(), len(records)))
+        if offset != self.offset:
+            await asyncio.to_thread(self._commit, offset)
+        self.healthy = True
+        return len(records)
+
+    def _update_rate(self):
+        # 最近 10 秒的平均補寫速度 (筆/秒)
+        now = time.monotonic()
+        while self._replay_window and now - self._replay_window[0][0] > 10:
+            self._replay_window.popleft()
+        self.stats["replay_rate"] = round(sum(n for _, n in self._replay_window) / 10, 1)
+
+    #以下在 thread 裡執行，只有背景 task 會呼叫
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:016d}{SEGMENT_SUFFIX}")
+
+    def _acquire_slot(self) -> str:
+        # 多個 worker 各自鎖一個子目錄，重啟後會拿回原本的目錄把資料補寫完
+        for slot in range(SPOOL_MAX_SLOTS if fcntl else 1):
+            directory = os.path.join(self.root, str(slot))
+            os.makedirs(directory, exist_ok=True)
+            lock_file = open(os.path.join(directory, "lock"), "a")
+            if fcntl is None:
+                self._lock_file = lock_file
+                return directory
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            self._lock_file = lock_file
+            return directory
+        raise RuntimeError("沒有可用的 spool 目錄")
+
+    def _open(self):
+        self.directory = self._acquire_slot()
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                self.segments[seq] = os.path.getsize(self._path(seq))
+
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as f:
+                saved = json.load(f)
+            self.offset = (saved["segment"], saved["position"])
+        except FileNotFoundError:
+            self.offset = (min(self.segments, default=0), 0)
+
+        # 已補寫完的 segment，以及之前啟動後沒寫入任何資料的空 segment
+        for seq in [seq for seq, size in self.segments.items() if seq < self.offset[0] or size == 0]:
+            self._remove(seq)
+
+        # 上次可能寫到一半就當機，永遠從新的 segment 開始寫
+        self._roll(max(self.segments, default=self.offset[0]) + 1)
+        if self.offset[0] not in self.segments:
+            self.offset = (min(self.segments), 0)
+        self._update_depth()
+
+    def _roll(self, seq: int):
+        if self.active:
+            self.active.close()
+        self.active_seq = seq
+        self.active = open(self._path(seq), "ab")
+        self.segments[seq] = self.active.tell()
+
+    def _remove(self, seq: int):
+        try:
+            os.remove(self._path(seq))
+        except FileNotFoundError:
+            pass
+        self.segments.pop(seq, None)
+
+    def _update_depth(self):
+        seq, position = self.offset
+        self.stats["depth_bytes"] = sum(size for s, size in self.segments.items() if s >= seq) - position
+        self.stats["segments"] = len(self.segments)
+
+    def _append(self, records: List[Tuple[str, dict]]) -> int:
+        written = 0
+        for collection_name, doc in records:
+            payload = bson.encode({"c": collection_name, "d": doc})
+            if self.stats["depth_bytes"] + len(payload) > self.max_bytes:
+                break
+            if self.segments[self.active_seq] >= self.segment_bytes:
+                self._roll(self.active_seq + 1)
+            self.active.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.segments[self.active_seq] += RECORD_HEADER.size + len(payload)
+            self.stats["depth_bytes"] += RECORD_HEADER.size + len(payload)
+            written += 1
+        self.active.flush()
+        if SPOOL_FSYNC:
+            os.fsync(self.active.fileno())
+        self.stats["segments"] = len(self.segments)
+        return written
+
+    def _read(self, limit: int) -> Tuple[List[Tuple[str, dict]], Tuple[int, int]]:
+        records = []
+        seq, position = self.offset
+        while len(records) < limit and seq in self.segments:
+            end = self.segments[seq]
+            with open(self._path(seq), "rb") as f:
+                f.seek(position)
+                while len(records) < limit and position < end:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, crc = RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        break
+                    record = bson.decode(payload)
+                    records.append((record["c"], record["d"]))
+                    position += RECORD_HEADER.size + length
+
+            if position < end and len(records) < limit:
+                # 當機留下的半筆或壞掉的紀錄，跳過這個 segment 剩下的部分
+                if seq == self.active_seq:
+                    break
+                self.stats["corrupted"] += 1
+                print(f"spool segment 損毀，略過 {end - position} bytes: {self._path(seq)}")
+                position = end
+            if position >= end and seq != self.active_seq:
+                seq, position = min((s for s in self.segments if s > seq), default=self.active_seq), 0
+                continue
+            break
+        return records, (seq, position)
+
+    def _commit(self, offset: Tuple[int, int]):
+        path = os.path.join(self.directory, OFFSET_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": offset[0], "position": offset[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.offset = offset
+        # 已經補寫完的 segment 可以刪掉
+        for seq in [seq for seq in self.segments if seq < offset[0]]:
+            self._remove(seq)
+        self._update_depth()
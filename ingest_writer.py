@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+from typing import Dict, List
+from pymongo.errors import BulkWriteError
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_MAX_LATENCY_MS = int(os.getenv("INGEST_MAX_LATENCY_MS", "200"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "50000"))
+INGEST_WRITE_TIMEOUT = float(os.getenv("INGEST_WRITE_TIMEOUT", "10"))
+
+DUPLICATE_KEY = 11000
+
+#每個月份 collection 各自排隊，滿 batch_size 或超過 max_latency 就用 insert_many 寫入
+#有 spool 時，寫入失敗/逾時或佇列滿了就先落地，由 spool 在 DB 恢復後補寫
+class IngestWriter:
+    def __init__(self, db, index_manager=None, catalog=None, spool=None, batch_size: int = INGEST_BATCH_SIZE, max_latency_ms: int = INGEST_MAX_LATENCY_MS, max_pending: int = INGEST_MAX_PENDING):
+        self.db = db
+        self.index_manager = index_manager
+        self.catalog = catalog
+        self.spool = spool
+        self.batch_size = batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.max_pending = max_pending
+        self.buffers: Dict[str, List[dict]] = {}
+        self.first_enqueued: Dict[str, float] = {}
+        self.pending = 0
+        self.stats = {"queued": 0, "written": 0, "failed": 0, "spooled": 0, "batches": 0}
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._task = None
+        self._closing = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self.spool:
+            self.spool.start(self._replay)
+
+    async def stop(self):
+        # 關機時停止排程並把剩下的資料全部寫完
+        self._closing = True
+        self._wakeup.set()
+        self._space.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush(force=True)
+        if self.spool:
+            await self.spool.stop()
+
+    async def put(self, collection_name: str, doc: dict):
+        # 佇列滿了先落地到 spool，spool 也滿了才等寫入騰出空間 (backpressure 回到 socket 讀取端)
+        if self.pending >= self.max_pending and self.spool and self.spool.put(collection_name, [doc]):
+            self.stats["queued"] += 1
+            self.stats["spooled"] += 1
+            return
+        while self.pending >= self.max_pending and not self._closing:
+            self._space.clear()
+            await self._space.wait()
+
+        buf = self.buffers.setdefault(collection_name, [])
+        if not buf:
+            self.first_enqueued[collection_name] = time.monotonic()
+        buf.append(doc)
+        self.pending += 1
+        self.stats["queued"] += 1
+
+        if len(buf) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            timeout = self._next_deadline()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _next_deadline(self):
+        if not self.first_enqueued:
+            return self.max_latency
+        oldest = min(self.first_enqueued.values())
+        return max(0, oldest + self.max_latency - time.monotonic())
+
+    async def flush(self, force: bool = False):
+        now = time.monotonic()
+        jobs = []
+        for name in list(self.buffers.keys()):
+            buf = self.buffers[name]
+            if force or len(buf) >= self.batch_size or now - self.first_enqueued[name] >= self.max_latency:
+                docs = self.buffers.pop(name)
+                self.first_enqueued.pop(name, None)
+                # DB 剛失敗過就直接落地，不再每批等逾時
+                if self.spool and not self.spool.healthy and self.spool.put(name, docs):
+                    self._spooled(docs)
+                    continue
+                jobs.append(self._write(name, docs))
+        if jobs:
+            await asyncio.gather(*jobs)
+
+    def _spooled(self, docs: List[dict]):
+        self.stats["spooled"] += len(docs)
+        self.pending -= len(docs)
+        self._space.set()
+
+    async def _ensure_index(self, collection_name: str):
+        if self.index_manager:
+            # 新的月份 collection 第一次寫入前先建 timestamp 索引
+            try:
+                await self.index_manager.ensure_timestamp_index(collection_name)
+            except Exception as e:
+                print(f"建立 timestamp 索引失敗 ({collection_name}): {e}")
+
+    async def _write(self, collection_name: str, docs: List[dict]):
+        await self._ensure_index(collection_name)
+        for i in range(0, len(docs), self.batch_size):
+            chunk = docs[i:i + self.batch_size]
+            try:
+                await asyncio.wait_for(self.db[collection_name].insert_many(chunk, ordered=False), INGEST_WRITE_TIMEOUT)
+                self.stats["written"] += len(chunk)
+                if self.catalog:
+                    self.catalog.add(collection_name)
+            except BulkWriteError as e:
+                errors = len(e.details.get("writeErrors", []))
+                self.stats["written"] += e.details.get("nInserted", len(chunk) - errors)
+                self.stats["failed"] += errors
+                print(f"批次寫入部分失敗 ({collection_name}): {errors} 筆")
+            except Exception as e:
+                if self.spool and self.spool.put(collection_name, chunk):
+                    self.spool.mark_unhealthy()
+                    self.stats["spooled"] += len(chunk)
+                    print(f"批次寫入失敗，改寫入 spool ({collection_name}): {e!r}")
+                else:
+                    self.stats["failed"] += len(chunk)
+                    print(f"批次寫入失敗 ({collection_name}): {e!r}")
+            finally:
+                self.stats["batches"] += 1
+                self.pending -= len(chunk)
+                self._space.set()
+
+    async def _replay(self, collection_name: str, docs: List[dict]):
+        # spool 補寫：失敗就丟例外讓 spool 稍後重試；重複的 _id 代表之前其實已寫入
+        await self._ensure_index(collection_name)
+        try:
+            await self.db[collection_name].insert_many(docs, ordered=False)
+            self.stats["written"] += len(docs)
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            failed = sum(1 for err in write_errors if err.get("code") != DUPLICATE_KEY)
+            self.stats["written"] += e.details.get("nInserted", 0)
+            self.stats["failed"] += failed
+            if failed:
+                print(f"spool 補寫部分失敗 ({collection_name}): {failed} 筆")
+        if self.catalog:
+            self.catalog.add(collection_name)
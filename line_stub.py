@@ -0,0 +1,92 @@
+import argparse
+import os
+import time
+from collections import deque
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+LINE_STUB_RATE = int(os.getenv("LINE_STUB_RATE", "10"))
+LINE_MULTICAST_MAX = 500
+
+#本機假的 LINE Messaging API，離線測試告警推播用
+#記錄每一次呼叫，每秒超過 rate 次就回 429；POST /stub/fail 可以指定接下來幾次回特定錯誤
+#使用方式: python line_stub.py --port 8081，然後在 .env 設 LINE_API_BASE=http://127.0.0.1:8081
+app = FastAPI()
+app.state.rate = LINE_STUB_RATE
+app.state.calls = []
+app.state.window = deque()
+app.state.retry_keys = set()
+app.state.failures = deque()
+
+def _throttled() -> bool:
+    now = time.monotonic()
+    window = app.state.window
+    while window and now - window[0] >= 1:
+        window.popleft()
+    if len(window) >= app.state.rate:
+        return True
+    window.append(now)
+    return False
+
+@app.post("/v2/bot/message/{kind}")
+async def message(kind: str, request: Request):
+    body = await request.json()
+    retry_key = request.headers.get("X-Line-Retry-Key")
+    call = {"kind": kind, "body": body, "retry_key": retry_key, "time": time.time()}
+    app.state.calls.append(call)
+
+    if app.state.failures:
+        status = call["status"] = app.state.failures.popleft()
+        headers = {"Retry-After": "1"} if status == 429 else None
+        return JSONResponse({"message": "Injected failure"}, status_code=status, headers=headers)
+
+    if _throttled():
+        call["status"] = 429
+        return JSONResponse({"message": "The API rate limit has been exceeded. Try again later."},
+                            status_code=429, headers={"Retry-After": "1"})
+
+    if kind == "multicast" and not 0 < len(body.get("to", [])) <= LINE_MULTICAST_MAX:
+        call["status"] = 400
+        return JSONResponse({"message": "The request body has 1 error(s)"}, status_code=400)
+
+    # 和 LINE 一樣，同一個 retry key 第二次送達回 409
+    if retry_key:
+        if retry_key in app.state.retry_keys:
+            call["status"] = 409
+            return JSONResponse({"message": "The retry key is already accepted"}, status_code=409)
+        app.state.retry_keys.add(retry_key)
+
+    call["status"] = 200
+    return {}
+
+@app.get("/stub/calls")
+async def get_calls():
+    return {
+        "total": len(app.state.calls),
+        "throttled": sum(1 for call in app.state.calls if call.get("status") == 429),
+        "calls": app.state.calls
+    }
+
+@app.delete("/stub/calls")
+async def reset_calls():
+    app.state.calls.clear()
+    app.state.window.clear()
+    app.state.retry_keys.clear()
+    app.state.failures.clear()
+    return {"status": "ok"}
+
+@app.post("/stub/fail")
+async def inject_failures(status: int = 500, count: int = 1):
+    # 接下來 count 次呼叫回 status (429 會帶 Retry-After: 1)
+    app.state.failures.extend([status] * count)
+    return {"pending": len(app.state.failures)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rate", type=int, default=LINE_STUB_RATE, help="每秒允許的請求數")
+    args = parser.parse_args()
+    app.state.rate = args.rate
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "50"))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+
+BIND_SUCCESS = "{account} 已完成 LINE 綁定！"
+BIND_FAILED = "綁定碼錯誤或已過期，請確認是否在網站產生新綁定碼。"
+
+#LINE webhook 背景處理：API 驗證簽章後只負責丟進佇列並馬上回 200
+#佇列滿時回 503 讓 LINE 重送，已排入的事件重送時會被 webhookEventId 擋掉
+#worker 一次取一批事件，綁定碼用一次 $in 查詢，回覆同時送出
+class WebhookProcessor:
+    def __init__(self, subscriber_collection, reply, workers: int = WEBHOOK_WORKERS,
+                 queue_size: int = WEBHOOK_QUEUE_SIZE, batch_size: int = WEBHOOK_BATCH_SIZE):
+        self.subscribers = subscriber_collection
+        self.reply = reply
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.seen: "OrderedDict[str, None]" = OrderedDict()
+        self.stats = {"received": 0, "duplicates": 0, "dropped": 0, "bound": 0, "rejected": 0}
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 5):
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"webhook 佇列未清空，剩餘 {self.queue.qsize()} 筆")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _is_duplicate(self, event: dict) -> bool:
+        # LINE 重送時 webhookEventId 不變
+        event_id = event.get("webhookEventId")
+        return bool(event_id) and event_id in self.seen
+
+    def _mark_seen(self, event: dict):
+        event_id = event.get("webhookEventId")
+        if not event_id:
+            return
+        self.seen[event_id] = None
+        if len(self.seen) > WEBHOOK_DEDUP_SIZE:
+            self.seen.popitem(last=False)
+
+    def submit(self, events: list) -> int:
+        # 回傳沒排進佇列的事件數；成功排入後才記為已收到，丟掉的事件等 LINE 重送
+        dropped = 0
+        for event in events:
+            self.stats["received"] += 1
+            if self._is_duplicate(event):
+                self.stats["duplicates"] += 1
+                continue
+            try:
+                self.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.stats["dropped"] += 1
+                dropped += 1
+                continue
+            self._mark_seen(event)
+        if dropped:
+            print(f"webhook 佇列已滿，{dropped} 筆事件等待 LINE 重送")
+        return dropped
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self._process(batch)
+            except Exception as e:
+                print(f"webhook 處理失敗: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _process(self, events: list):
+        bindings = []
+        for event in events:
+            if event.get("type") != "message":
+                continue
+            message = event.get("message", {})
+            if message.get("type") != "text":
+                continue
+
+            text = message.get("text", "").strip()
+            # replyToken 用來回覆
+            reply_token = event.get("replyToken")
+            # 取得 line user id
+            line_user_id = event.get("source", {}).get("userId")
+
+            if not text or not reply_token or not line_user_id:
+                # 忽略不完整事件
+                continue
+            bindings.append((text, reply_token, line_user_id))
+
+        if not bindings:
+            return
+
+        # 一次查出這批所有有效的綁定碼
+        now_ts = int(time.time())
+        candidates = await self.subscribers.find(
+            {"binding_code": {"$in": list({text for text, _, _ in bindings})}, "binding_expiry": {"$gt": now_ts}},
+            {"binding_code": 1, "account": 1}
+        ).to_list(None)
+        by_code = {doc["binding_code"]: doc for doc in candidates}
+
+        await asyncio.gather(*[self._bind(by_code.get(text), text, reply_token, line_user_id)
+                               for text, reply_token, line_user_id in bindings])
+
+    async def _bind(self, subscriber, code: str, reply_token: str, line_user_id: str):
+        bound = False
+        if subscriber:
+            # 條件更新：同一個綁定碼只會成功一次
+            result = await self.subscribers.update_one(
+                {"_id": subscriber["_id"], "binding_code": code},
+                {"$set": {"line_user_id": line_user_id}, "$unset": {"binding_code": "", "binding_expiry": ""}}
+            )
+            bound = result.modified_count == 1
+
+        try:
+            if bound:
+                # 綁定成功
+                self.stats["bound"] += 1
+                await self.reply(reply_token, BIND_SUCCESS.format(account=subscriber["account"]))
+            else:
+                self.stats["rejected"] += 1
+                await self.reply(reply_token, BIND_FAILED)
+        except Exception as e:
+            print(f"LINE 回覆失敗: {e}")
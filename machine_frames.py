@@ -0,0 +1,109 @@
+import json
+import os
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+from fastapi import WebSocket, WebSocketDisconnect
+
+# 二進位格式為選用套件，沒裝就只支援 JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+FRAME_MAX_READINGS = int(os.getenv("FRAME_MAX_READINGS", "1000"))
+FRAME_SUBPROTOCOL_PREFIX = "iot."
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def _decode_msgpack(payload: bytes):
+    # timestamp=3: MessagePack 的 timestamp extension 直接解成 datetime
+    return msgpack.unpackb(payload, raw=False, timestamp=3)
+
+DECODERS = {"json": json.loads}
+if msgpack is not None:
+    DECODERS["msgpack"] = _decode_msgpack
+if cbor2 is not None:
+    DECODERS["cbor"] = cbor2.loads
+
+#連線時決定格式：?format=msgpack 或 Sec-WebSocket-Protocol: iot.msgpack，都沒有就是 JSON
+#回傳 (格式, 要回給 client 的 subprotocol)，格式不支援時格式為 None
+def negotiate_format(requested: Optional[str], subprotocols: List[str]) -> Tuple[Optional[str], Optional[str]]:
+    if requested:
+        return (requested if requested in DECODERS else None), None
+    for protocol in subprotocols:
+        if protocol.startswith(FRAME_SUBPROTOCOL_PREFIX):
+            fmt = protocol[len(FRAME_SUBPROTOCOL_PREFIX):]
+            if fmt in DECODERS:
+                return fmt, protocol
+    return "json", None
+
+def parse_timestamp(value, strict: bool = False) -> datetime:
+    # 一律轉成不帶時區的 UTC datetime，和資料庫裡的格式一致
+    # strict=False 時解析失敗用現在時間，strict=True 時丟 ValueError
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # epoch 秒；超過 1e11 視為毫秒
+        if value > 1e11:
+            value = value / 1000
+        try:
+            return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+        except (OverflowError, OSError, ValueError):
+            pass
+    elif isinstance(value, str) and value:
+        # fromisoformat 是 C 實作，比 strptime 快很多，也接受 "%Y-%m-%d %H:%M:%S"
+        try:
+            return parse_timestamp(datetime.fromisoformat(value))
+        except ValueError:
+            pass
+    if strict:
+        raise ValueError(f"無法解析 timestamp: {value!r}")
+    return datetime.utcnow()
+
+#一個 frame 可以是單筆 {"machine", "timestamp", "values"}
+#或批次 {"machine": 預設機台, "readings": [{"timestamp", "values"}, ...]}
+def decode_frame(fmt: str, payload) -> List[dict]:
+    data = DECODERS[fmt](payload)
+    default_machine = None
+    if isinstance(data, dict) and "readings" in data:
+        default_machine = data.get("machine")
+        readings = data["readings"]
+    elif isinstance(data, list):
+        readings = data
+    else:
+        readings = [data]
+
+    if not isinstance(readings, list):
+        raise ValueError("readings 必須是陣列")
+    if len(readings) > FRAME_MAX_READINGS:
+        raise ValueError(f"單一 frame 最多 {FRAME_MAX_READINGS} 筆資料")
+
+    result = []
+    for reading in readings:
+        if not isinstance(reading, dict):
+            continue
+        machine = reading.get("machine", default_machine)
+        if not machine:
+            continue
+        values = reading.get("values")
+        result.append({
+            "machine": machine,
+            "timestamp": parse_timestamp(reading.get("timestamp")),
+            "values": values if isinstance(values, dict) else {}
+        })
+    return result
+
+async def receive_frame(websocket: WebSocket):
+    # text / binary frame 都收，JSON 也可以用 binary frame 送
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    if message.get("text") is not None:
+        return message["text"]
+    return message.get("bytes")
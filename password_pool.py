@@ -0,0 +1,56 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+from fastapi import HTTPException
+
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "32"))
+
+#bcrypt 很吃 CPU，放到獨立的 thread pool (bcrypt 會釋放 GIL) 避免卡住 event loop
+#排隊的工作超過上限時直接回 503，不讓登入尖峰拖垮 WebSocket
+class PasswordPool:
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_pending: int = PASSWORD_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.stats = {"hashed": 0, "checked": 0, "rejected": 0, "queue_time_ms_avg": 0.0, "queue_time_ms_max": 0.0}
+        self._queue_time_total = 0.0
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="系統忙碌中，請稍後再試", headers={"Retry-After": "1"})
+
+        self.pending += 1
+        enqueued = time.perf_counter()
+
+        def job():
+            waited = time.perf_counter() - enqueued
+            return waited, fn(*args)
+
+        try:
+            waited, result = await asyncio.get_running_loop().run_in_executor(self.executor, job)
+        finally:
+            self.pending -= 1
+
+        waited_ms = waited * 1000
+        done = self.stats["hashed"] + self.stats["checked"] + 1
+        self._queue_time_total += waited_ms
+        self.stats["queue_time_ms_avg"] = round(self._queue_time_total / done, 3)
+        self.stats["queue_time_ms_max"] = round(max(self.stats["queue_time_ms_max"], waited_ms), 3)
+        return result
+
+    async def hash(self, password: str) -> bytes:
+        result = await self._run(lambda: bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()))
+        self.stats["hashed"] += 1
+        return result
+
+    async def check(self, password: str, hashed: bytes) -> bool:
+        result = await self._run(bcrypt.checkpw, password.encode("utf-8"), hashed)
+        self.stats["checked"] += 1
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
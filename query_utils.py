@@ -0,0 +1,122 @@
+import asyncio
+import heapq
+import os
+import re
+from datetime import datetime
+from typing import List
+from dateutil.relativedelta import relativedelta
+
+SEARCH_BATCH_SIZE = int(os.getenv("SEARCH_BATCH_SIZE", "2000"))
+SEARCH_PREFETCH_BATCHES = int(os.getenv("SEARCH_PREFETCH_BATCHES", "2"))
+AGGREGATE_MAX_BUCKETS = int(os.getenv("AGGREGATE_MAX_BUCKETS", "10000"))
+
+SENSOR_PROJECTION = {"_id": 0, "timestamp": 1, "machine": 1, "values": 1}
+
+#多個月份 collection 同時查詢，各自按 timestamp 排序後再合併
+#每個 cursor 由背景 task 預先抓 batch 放進有上限的佇列，記憶體用量固定
+async def merge_sorted_cursors(cursors: List, key: str = "timestamp", prefetch: int = SEARCH_PREFETCH_BATCHES):
+    queues = [asyncio.Queue(maxsize=prefetch) for _ in cursors]
+
+    async def pump(cursor, queue: asyncio.Queue):
+        try:
+            batch = []
+            async for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= SEARCH_BATCH_SIZE:
+                    await queue.put(batch)
+                    batch = []
+            if batch:
+                await queue.put(batch)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    tasks = [asyncio.create_task(pump(cursor, queue)) for cursor, queue in zip(cursors, queues)]
+
+    async def next_batch(i: int):
+        item = await queues[i].get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    try:
+        heap = []
+        for i in range(len(cursors)):
+            batch = await next_batch(i)
+            if batch:
+                heap.append((batch[0][key], i, 0, batch))
+        heapq.heapify(heap)
+
+        while heap:
+            _, i, idx, batch = heap[0]
+            yield batch[idx]
+            idx += 1
+            if idx >= len(batch):
+                batch = await next_batch(i)
+                idx = 0
+            if batch:
+                heapq.heapreplace(heap, (batch[idx][key], i, idx, batch))
+            else:
+                heapq.heappop(heap)
+    finally:
+        # client 中途斷線時也要停掉還在抓資料的 task
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def monthly_collection_names(company_lab: str, machine: str, start_dt: datetime, end_dt: datetime) -> List[str]:
+    names = []
+    current = datetime(start_dt.year, start_dt.month, 1)
+    while current <= end_dt:
+        names.append(f"{company_lab}-{machine}-{current.year}-{current.month}")
+        current += relativedelta(months=1)
+    return names
+
+BUCKET_UNITS = {"s": ("second", 1), "m": ("minute", 60), "h": ("hour", 3600), "d": ("day", 86400)}
+BUCKET_PATTERN = re.compile(r"^(\d+)([smhd])$")
+METRIC_PATTERN = re.compile(r"^[A-Za-z0-9_]+$")
+
+def parse_bucket(bucket: str):
+    # "5m" -> ("minute", 5, 300)
+    match = BUCKET_PATTERN.match(bucket)
+    if not match or int(match.group(1)) <= 0:
+        return None
+    size = int(match.group(1))
+    unit, seconds = BUCKET_UNITS[match.group(2)]
+    return unit, size, size * seconds
+
+#時間分桶統計：第一個月份 collection 為主，其餘用 $unionWith 併入，再以 $dateTrunc 分組
+def build_bucket_pipeline(collection_names: List[str], start_dt: datetime, end_dt: datetime,
+                          unit: str, size: int, metrics: List[str], percentiles: List[float]):
+    match = {"$match": {"timestamp": {"$gte": start_dt, "$lte": end_dt}}}
+    pipeline = [match]
+    for name in collection_names[1:]:
+        pipeline.append({"$unionWith": {"coll": name, "pipeline": [match]}})
+
+    group = {"_id": {"$dateTrunc": {"date": "$timestamp", "unit": unit, "binSize": size}}}
+    for metric in metrics:
+        field = f"$values.{metric}"
+        group[f"{metric}__min"] = {"$min": field}
+        group[f"{metric}__max"] = {"$max": field}
+        group[f"{metric}__avg"] = {"$avg": field}
+        group[f"{metric}__count"] = {"$sum": {"$cond": [{"$isNumber": field}, 1, 0]}}
+        if percentiles:
+            # $percentile 需要 MongoDB 7.0 以上
+            group[f"{metric}__pct"] = {"$percentile": {"input": field, "p": percentiles, "method": "approximate"}}
+    pipeline.append({"$group": group})
+    pipeline.append({"$sort": {"_id": 1}})
+    return pipeline
+
+def bucket_doc_to_result(doc: dict, metrics: List[str], percentiles: List[float]) -> dict:
+    result = {}
+    for metric in metrics:
+        stats = {
+            "min": doc.get(f"{metric}__min"),
+            "max": doc.get(f"{metric}__max"),
+            "avg": doc.get(f"{metric}__avg"),
+            "count": doc.get(f"{metric}__count", 0),
+        }
+        for p, value in zip(percentiles, doc.get(f"{metric}__pct") or []):
+            stats[f"p{p * 100:g}"] = value
+        result[metric] = stats
+    return {"timestamp": doc["_id"].strftime("%Y-%m-%d %H:%M:%S"), "metrics": result}
@@ -0,0 +1,152 @@
+import asyncio
+import os
+from array import array
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from bson import ObjectId
+from dateutil.relativedelta import relativedelta
+
+RECENT_BUFFER_SIZE = int(os.getenv("RECENT_BUFFER_SIZE", "1000"))
+
+EPOCH = datetime(1970, 1, 1)
+
+#欄位型態：0 = 無資料，1 = float，2 = int
+MISSING, FLOAT, INT = 0, 1, 2
+
+#單一機器的環狀緩衝區：_id / timestamp / 每個 metric 各一個固定長度的陣列
+class MachineRing:
+    def __init__(self, machine: str, capacity: int):
+        self.machine = machine
+        self.capacity = capacity
+        self.ids = bytearray(12 * capacity)
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.columns: Dict[str, Tuple[array, bytearray]] = {}
+        self.extras: Dict[int, dict] = {}  # 非數值的欄位
+        self.head = 0
+        self.size = 0
+        self.ready = False
+        self.complete = False
+        self.pending = deque(maxlen=capacity)
+
+    def append(self, doc: dict):
+        if not self.ready:
+            # 預載完成前先暫存
+            self.pending.append(doc)
+            return
+        self._write(doc)
+
+    def _write(self, doc: dict):
+        pos = self.head
+        self.ids[pos * 12:(pos + 1) * 12] = doc["_id"].binary
+        self.timestamps[pos] = (doc["timestamp"] - EPOCH).total_seconds()
+        self.extras.pop(pos, None)
+
+        values = doc.get("values") or {}
+        for metric, (column, kinds) in self.columns.items():
+            if metric not in values:
+                kinds[pos] = MISSING
+        for metric, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                self.extras.setdefault(pos, {})[metric] = value
+                if metric in self.columns:
+                    self.columns[metric][1][pos] = MISSING
+                continue
+            if metric not in self.columns:
+                self.columns[metric] = (array("d", bytes(8 * self.capacity)), bytearray(self.capacity))
+            column, kinds = self.columns[metric]
+            column[pos] = value
+            kinds[pos] = INT if isinstance(value, int) else FLOAT
+
+        self.head = (pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def load(self, history: List[dict]):
+        # history 為 DB 由新到舊的結果，與預載期間收到的資料合併 (以 _id 去重)
+        pending_ids = {doc["_id"] for doc in self.pending}
+        docs = [doc for doc in reversed(history) if doc["_id"] not in pending_ids] + list(self.pending)
+        for doc in docs[-self.capacity:]:
+            self._write(doc)
+        self.complete = len(history) < self.capacity
+        self.pending.clear()
+        self.ready = True
+
+    def _read(self, pos: int) -> dict:
+        values = {}
+        for metric, (column, kinds) in self.columns.items():
+            kind = kinds[pos]
+            if kind == INT:
+                values[metric] = int(column[pos])
+            elif kind == FLOAT:
+                values[metric] = column[pos]
+        values.update(self.extras.get(pos, {}))
+        return {
+            "_id": str(ObjectId(bytes(self.ids[pos * 12:(pos + 1) * 12]))),
+            "timestamp": EPOCH + timedelta(seconds=self.timestamps[pos]),
+            "machine": self.machine,
+            "values": values
+        }
+
+    def latest(self, number: int) -> List[dict]:
+        number = min(number, self.size)
+        return [self._read((self.head - number + i) % self.capacity) for i in range(number)]
+
+#(company_lab, machine) -> MachineRing
+#只有負責該機器 WebSocket 的 process 會有 ring，其他 process 查詢時走 DB
+class RecentBuffer:
+    def __init__(self, db, capacity: int = RECENT_BUFFER_SIZE):
+        self.db = db
+        self.capacity = capacity
+        self.rings: Dict[Tuple[str, str], MachineRing] = {}
+        self.stats = {"hits": 0, "misses": 0}
+        self._tasks = set()
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def append(self, company_lab: str, machine: str, doc: dict):
+        key = (company_lab, machine)
+        ring = self.rings.get(key)
+        if ring is None:
+            ring = self.rings[key] = MachineRing(machine, self.capacity)
+            # 保留 task 參考，避免預載到一半被 GC，ring 永遠不會 ready
+            task = asyncio.create_task(self._preload(company_lab, machine, ring))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        ring.append(doc)
+
+    async def _preload(self, company_lab: str, machine: str, ring: MachineRing):
+        now = datetime.utcnow()
+        last_month = now - relativedelta(months=1)
+        history = []
+        try:
+            for month in (now, last_month):
+                if len(history) >= self.capacity:
+                    break
+                collection_name = f"{company_lab}-{machine}-{month.year}-{month.month}"
+                cursor = self.db[collection_name].find().sort("timestamp", -1).limit(self.capacity - len(history))
+                history += await cursor.to_list(None)
+        except Exception as e:
+            print(f"最新資料預載失敗 ({company_lab}-{machine}): {e}")
+            # 只保留預載期間收到的資料，不視為完整
+            ring.load([])
+            ring.complete = False
+            return
+        ring.load(history)
+
+    def get(self, company_lab: str, machine: str, number: int) -> Optional[List[dict]]:
+        ring = self.rings.get((company_lab, machine))
+        if ring is None or not ring.ready or number <= 0 or number > self.capacity:
+            self.stats["misses"] += 1
+            return None
+        if number > ring.size and not ring.complete:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return ring.latest(number)
+
+    def drop(self, company_lab: str, machine: str):
+        # 機器斷線後這個 process 不再收到它的資料，ring 會過期
+        self.rings.pop((company_lab, machine), None)
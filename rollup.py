@@ -0,0 +1,470 @@
+import argparse
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+ROLLUP_FLUSH_SECONDS = float(os.getenv("ROLLUP_FLUSH_SECONDS", "5"))
+ROLLUP_MAX_PENDING = int(os.getenv("ROLLUP_MAX_PENDING", "200000"))
+ROLLUP_WRITER_STALE_SECONDS = float(os.getenv("ROLLUP_WRITER_STALE_SECONDS", "60"))
+
+#rollup_state：每台機台一筆 {company_lab, machine, start, flushed}
+#start 之後的資料才保證都在 rollup 裡，flushed 是已寫入 rollup 的最新資料時間
+#rollup_gaps：寫入結果不確定或被丟棄的區段，這些範圍要改查原始資料
+ROLLUP_STATE_COLLECTION = "rollup_state"
+ROLLUP_GAPS_COLLECTION = "rollup_gaps"
+#rollup_writers：每個執行中的 RollupWriter 一筆 {host, pid, heartbeat, synced}，正常關機才會刪掉
+#留下來的代表上次沒有正常關機，記憶體裡還沒寫入的增量已遺失
+ROLLUP_WRITERS_COLLECTION = "rollup_writers"
+COVERAGE_ALL = datetime(1970, 1, 1)
+
+#rollup 解析度：名稱 -> (秒數, $dateTrunc unit)
+ROLLUP_RESOLUTIONS = {"1m": (60, "minute"), "1h": (3600, "hour")}
+
+#每筆 rollup：{company_lab, machine, bucket, count, metrics: {metric: {count, sum, min, max}}}
+def rollup_collection_name(resolution: str) -> str:
+    return f"rollup_{resolution}"
+
+def truncate(timestamp: datetime, seconds: int) -> datetime:
+    if seconds == 3600:
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(second=0, microsecond=0)
+
+def _valid_metric(key: str) -> bool:
+    return bool(key) and "." not in key and not key.startswith("$")
+
+def _process_alive(pid: int) -> bool:
+    # Windows 的 signal 0 是 CTRL_C_EVENT，只能看 heartbeat
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def writer_crashed(writer: dict, now: datetime) -> bool:
+    # heartbeat 太久沒更新，或同一台主機上的 process 已經不在
+    if now - writer["heartbeat"] > timedelta(seconds=ROLLUP_WRITER_STALE_SECONDS):
+        return True
+    return writer.get("host") == socket.gethostname() and not _process_alive(writer["pid"])
+
+#ingest 時累加在記憶體，定期用 bulk upsert ($inc / $min / $max) 寫回
+class RollupWriter:
+    def __init__(self, db, flush_seconds: float = ROLLUP_FLUSH_SECONDS):
+        self.db = db
+        self.flush_seconds = flush_seconds
+        self.pending: Dict[Tuple[str, str, str, datetime], dict] = {}
+        self.first_seen: Dict[Tuple[str, str], datetime] = {}
+        self.latest: Dict[Tuple[str, str], datetime] = {}
+        self.gaps: List[dict] = []
+        self.stats = {"upserts": 0, "failed": 0, "retried": 0, "gaps": 0}
+        self.writer_id = uuid.uuid4().hex
+        self.synced = None
+        self._task = None
+        self._closing = asyncio.Event()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # 不取消 task，避免寫到一半的增量遺失
+        self._closing.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush()
+        if self.pending or self.gaps:
+            # 沒寫完的增量會遺失：保留登記，下次啟動時補記 gap
+            print(f"rollup 關機時仍有 {len(self.pending)} 筆增量未寫入")
+            return
+        try:
+            await self.db[ROLLUP_WRITERS_COLLECTION].delete_one({"_id": self.writer_id})
+        except Exception as e:
+            print(f"rollup writer 登記刪除失敗: {e}")
+
+    def add(self, company_lab: str, machine: str, timestamp: datetime, values: dict):
+        machine_key = (company_lab, machine)
+        if machine_key not in self.first_seen:
+            # 第一次看到這台機台時，這個小時之前的資料不在 rollup 裡 (要跑 backfill)
+            self.first_seen[machine_key] = truncate(timestamp, 3600) + timedelta(hours=1)
+        latest = self.latest.get(machine_key)
+        if latest is None or timestamp > latest:
+            self.latest[machine_key] = timestamp
+
+        for resolution, (seconds, _) in ROLLUP_RESOLUTIONS.items():
+            key = (resolution, company_lab, machine, truncate(timestamp, seconds))
+            entry = self.pending.get(key)
+            if entry is None:
+                entry = self.pending[key] = {"count": 0, "metrics": {}}
+            entry["count"] += 1
+            for metric, value in (values or {}).items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or not _valid_metric(metric):
+                    continue
+                stats = entry["metrics"].get(metric)
+                if stats is None:
+                    entry["metrics"][metric] = {"count": 1, "sum": value, "min": value, "max": value}
+                else:
+                    stats["count"] += 1
+                    stats["sum"] += value
+                    if value < stats["min"]:
+                        stats["min"] = value
+                    if value > stats["max"]:
+                        stats["max"] = value
+
+    async def _register(self):
+        # 先登記自己，backfill 才知道有 server 在寫
+        now = datetime.utcnow()
+        self.synced = now
+        writers = self.db[ROLLUP_WRITERS_COLLECTION]
+        await writers.insert_one({"_id": self.writer_id, "host": socket.gethostname(), "pid": os.getpid(),
+                                  "started": now, "heartbeat": now, "synced": now})
+        await self._reap_crashed()
+
+    async def _reap_crashed(self):
+        # 啟動時檢查一次；其他主機的 writer 要等 heartbeat 過期，所以之後每次 heartbeat 也檢查
+        now = datetime.utcnow()
+        writers = self.db[ROLLUP_WRITERS_COLLECTION]
+        async for writer in writers.find({"_id": {"$ne": self.writer_id}}):
+            if not writer_crashed(writer, now):
+                continue
+            # 先記 gap 再刪登記；多個 worker 同時處理只會多記重複的 gap
+            await self._record_crash(writer, now)
+            await writers.delete_one({"_id": writer["_id"]})
+
+    async def _record_crash(self, writer: dict, now: datetime):
+        # 當掉的 writer 在 synced 之後收到的增量都沒寫進 rollup，
+        # 重啟後 flushed 會被推過這段，所以每台機台從 flushed (或 synced) 到現在都記成 gap
+        gaps = []
+        async for state in self.db[ROLLUP_STATE_COLLECTION].find({}):
+            if not state.get("flushed"):
+                continue
+            start = truncate(min(state["flushed"], writer["synced"]), 60)
+            gaps.append({"company_lab": state["company_lab"], "machine": state["machine"],
+                         "start": start, "end": now, "created_at": now})
+        if gaps:
+            await self.db[ROLLUP_GAPS_COLLECTION].insert_many(gaps, ordered=False)
+            self.stats["gaps"] += len(gaps)
+        print(f"rollup writer {writer['_id']} ({writer.get('host')}:{writer.get('pid')}) 未正常關機，記錄 {len(gaps)} 個 gap")
+
+    async def _heartbeat(self):
+        try:
+            await self.db[ROLLUP_WRITERS_COLLECTION].update_one(
+                {"_id": self.writer_id},
+                {"$set": {"heartbeat": datetime.utcnow(), "synced": self.synced}},
+                upsert=True
+            )
+            await self._reap_crashed()
+        except Exception as e:
+            print(f"rollup heartbeat 寫入失敗: {e}")
+
+    async def _run(self):
+        try:
+            await self._register()
+        except Exception as e:
+            print(f"rollup writer 登記失敗: {e}")
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+            await self._heartbeat()
+
+    def _merge_back(self, key, entry: dict):
+        # 寫入失敗的增量放回 pending，下次 flush 重試
+        current = self.pending.get(key)
+        if current is None:
+            if len(self.pending) >= ROLLUP_MAX_PENDING:
+                return False
+            self.pending[key] = entry
+            return True
+        current["count"] += entry["count"]
+        for metric, stats in entry["metrics"].items():
+            existing = current["metrics"].get(metric)
+            if existing is None:
+                current["metrics"][metric] = stats
+            else:
+                existing["count"] += stats["count"]
+                existing["sum"] += stats["sum"]
+                existing["min"] = min(existing["min"], stats["min"])
+                existing["max"] = max(existing["max"], stats["max"])
+        return True
+
+    def _add_gap(self, key):
+        resolution, company_lab, machine, bucket = key
+        seconds, _ = ROLLUP_RESOLUTIONS[resolution]
+        self.add_gap(company_lab, machine, bucket, bucket + timedelta(seconds=seconds - 1))
+
+    def add_gap(self, company_lab: str, machine: str, first: datetime, last: datetime):
+        # first ~ last 的資料 rollup 不完整，下次 flush 寫進 rollup_gaps；查詢改用原始資料
+        # 對齊到分鐘，涵蓋兩端所在的整個 bucket
+        start = truncate(first, 60)
+        end = truncate(last, 60) + timedelta(minutes=1)
+        for gap in self.gaps:
+            if gap["company_lab"] == company_lab and gap["machine"] == machine and gap["start"] <= end and gap["end"] >= start:
+                gap["start"] = min(gap["start"], start)
+                gap["end"] = max(gap["end"], end)
+                return
+        self.gaps.append({"company_lab": company_lab, "machine": machine, "start": start, "end": end, "created_at": datetime.utcnow()})
+        self.stats["gaps"] += 1
+
+    async def flush(self):
+        # 先把還沒寫進 DB 的 gap 補寫
+        if self.gaps:
+            try:
+                await self.db[ROLLUP_GAPS_COLLECTION].insert_many([dict(gap) for gap in self.gaps], ordered=False)
+                self.gaps = []
+            except Exception as e:
+                print(f"rollup gap 寫入失敗: {e}")
+
+        synced = datetime.utcnow()
+        if not self.pending:
+            self.synced = synced
+            return
+        pending, self.pending = self.pending, {}
+        latest, self.latest = self.latest, {}
+
+        ops: Dict[str, List[Tuple[tuple, UpdateOne]]] = {}
+        for key, entry in pending.items():
+            resolution, company_lab, machine, bucket = key
+            inc = {"count": entry["count"]}
+            mins = {}
+            maxs = {}
+            for metric, stats in entry["metrics"].items():
+                inc[f"metrics.{metric}.count"] = stats["count"]
+                inc[f"metrics.{metric}.sum"] = stats["sum"]
+                mins[f"metrics.{metric}.min"] = stats["min"]
+                maxs[f"metrics.{metric}.max"] = stats["max"]
+            update = {"$inc": inc}
+            if mins:
+                update["$min"] = mins
+                update["$max"] = maxs
+            ops.setdefault(resolution, []).append(
+                (key, UpdateOne({"company_lab": company_lab, "machine": machine, "bucket": bucket}, update, upsert=True))
+            )
+
+        failed_machines = set()
+        for resolution, items in ops.items():
+            requests = [request for _, request in items]
+            try:
+                await self.db[rollup_collection_name(resolution)].bulk_write(requests, ordered=False)
+                self.stats["upserts"] += len(requests)
+                continue
+            except BulkWriteError as e:
+                # 只有列在 writeErrors 的沒寫進去，其餘已生效
+                failed = {err["index"]: False for err in e.details.get("writeErrors", [])}
+                self.stats["upserts"] += len(requests) - len(failed)
+                print(f"rollup 部分寫入失敗 ({resolution}): {len(failed)} 筆")
+            except Exception as e:
+                # 不確定有沒有部分生效，重試之外也記成 gap，查詢時改用原始資料
+                failed = {i: True for i in range(len(requests))}
+                print(f"rollup 寫入失敗 ({resolution}): {e}")
+
+            self.stats["failed"] += len(failed)
+            for i, uncertain in failed.items():
+                key, _ = items[i]
+                failed_machines.add((key[1], key[2]))
+                if self._merge_back(key, pending[key]):
+                    self.stats["retried"] += 1
+                    if not uncertain:
+                        continue
+                self._add_gap(key)
+
+        # 全部寫入成功的機台才推進 flushed；失敗的等重試成功後再推進
+        state_ops = []
+        for machine_key, timestamp in latest.items():
+            if machine_key in failed_machines:
+                if machine_key not in self.latest or timestamp > self.latest[machine_key]:
+                    self.latest[machine_key] = timestamp
+                continue
+            company_lab, machine = machine_key
+            state_ops.append(UpdateOne(
+                {"company_lab": company_lab, "machine": machine},
+                {"$setOnInsert": {"start": self.first_seen[machine_key]}, "$max": {"flushed": timestamp}},
+                upsert=True
+            ))
+        if state_ops:
+            try:
+                await self.db[ROLLUP_STATE_COLLECTION].bulk_write(state_ops, ordered=False)
+            except Exception as e:
+                # 沒推進 flushed 只會讓查詢多走原始資料，下次 flush 再試
+                print(f"rollup 狀態寫入失敗: {e}")
+                for machine_key, timestamp in latest.items():
+                    if machine_key not in self.latest or timestamp > self.latest[machine_key]:
+                        self.latest[machine_key] = timestamp
+        if not failed_machines:
+            # 這之前收到的增量都已寫入
+            self.synced = synced
+
+    async def covers(self, company_lab: str, machine: str, start_dt: datetime, end_dt: datetime, resolution: str) -> bool:
+        # rollup 是否完整涵蓋 [start_dt, end_dt]：在 start 之後、已 flush、且沒有 gap
+        seconds, _ = ROLLUP_RESOLUTIONS[resolution]
+        state = await self.db[ROLLUP_STATE_COLLECTION].find_one({"company_lab": company_lab, "machine": machine})
+        if not state or not state.get("start") or not state.get("flushed"):
+            return False
+        if start_dt < state["start"] or end_dt + timedelta(seconds=1) > truncate(state["flushed"], seconds):
+            return False
+        for gap in self.gaps:
+            if gap["company_lab"] == company_lab and gap["machine"] == machine and gap["start"] <= end_dt and gap["end"] > start_dt:
+                return False
+        gap = await self.db[ROLLUP_GAPS_COLLECTION].find_one(
+            {"company_lab": company_lab, "machine": machine, "start": {"$lte": end_dt}, "end": {"$gt": start_dt}}
+        )
+        return gap is None
+
+#從 rollup 再分組：bucket 需是 rollup 解析度的整數倍
+def build_rollup_pipeline(company_lab: str, machine: str, start_dt: datetime, end_dt: datetime,
+                          unit: str, size: int, metrics: List[str]):
+    group = {"_id": {"$dateTrunc": {"date": "$bucket", "unit": unit, "binSize": size}}}
+    for metric in metrics:
+        group[f"{metric}__min"] = {"$min": f"$metrics.{metric}.min"}
+        group[f"{metric}__max"] = {"$max": f"$metrics.{metric}.max"}
+        group[f"{metric}__sum"] = {"$sum": f"$metrics.{metric}.sum"}
+        group[f"{metric}__count"] = {"$sum": f"$metrics.{metric}.count"}
+    avg = {
+        f"{metric}__avg": {"$cond": [
+            {"$gt": [f"${metric}__count", 0]},
+            {"$divide": [f"${metric}__sum", f"${metric}__count"]},
+            None
+        ]}
+        for metric in metrics
+    }
+    return [
+        {"$match": {"company_lab": company_lab, "machine": machine, "bucket": {"$gte": start_dt, "$lte": end_dt}}},
+        {"$group": group},
+        {"$addFields": avg},
+        {"$sort": {"_id": 1}},
+    ]
+
+#查詢範圍與 bucket 都對齊某個 rollup 解析度時才可能用 rollup，另外還要 RollupWriter.covers 確認資料完整
+def pick_rollup(start_dt: datetime, end_dt: datetime, bucket_seconds: int):
+    for resolution in ("1h", "1m"):
+        seconds, _ = ROLLUP_RESOLUTIONS[resolution]
+        if bucket_seconds % seconds:
+            continue
+        if truncate(start_dt, seconds) != start_dt:
+            continue
+        end_exclusive = end_dt + timedelta(seconds=1)
+        if truncate(end_exclusive, seconds) != end_exclusive:
+            continue
+        return resolution
+    return None
+
+#backfill：由月份 collection 重建 rollup (同一 bucket 直接取代)
+def build_backfill_pipeline(company_lab: str, machine: str, unit: str, resolution: str):
+    return [
+        {"$project": {
+            "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": unit}},
+            "kv": {"$objectToArray": {"$ifNull": ["$values", {}]}}
+        }},
+        {"$unwind": {"path": "$kv", "includeArrayIndex": "idx", "preserveNullAndEmptyArrays": True}},
+        {"$project": {
+            "bucket": 1,
+            "k": "$kv.k",
+            "v": {"$cond": [{"$isNumber": "$kv.v"}, "$kv.v", None]},
+            "first": {"$cond": [{"$or": [{"$eq": ["$idx", None]}, {"$eq": ["$idx", 0]}]}, 1, 0]}
+        }},
+        {"$group": {
+            "_id": {"bucket": "$bucket", "k": "$k"},
+            "readings": {"$sum": "$first"},
+            "count": {"$sum": {"$cond": [{"$eq": ["$v", None]}, 0, 1]}},
+            "sum": {"$sum": "$v"},
+            "min": {"$min": "$v"},
+            "max": {"$max": "$v"}
+        }},
+        {"$group": {
+            "_id": "$_id.bucket",
+            "count": {"$sum": "$readings"},
+            "metrics": {"$push": {"$cond": [
+                {"$and": [{"$ne": ["$_id.k", None]}, {"$gt": ["$count", 0]}]},
+                {"k": "$_id.k", "v": {"count": "$count", "sum": "$sum", "min": "$min", "max": "$max"}},
+                None
+            ]}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "company_lab": {"$literal": company_lab},
+            "machine": {"$literal": machine},
+            "bucket": "$_id",
+            "count": 1,
+            "metrics": {"$arrayToObject": {"$filter": {"input": "$metrics", "cond": {"$ne": ["$$this", None]}}}}
+        }},
+        {"$merge": {
+            "into": rollup_collection_name(resolution),
+            "on": ["company_lab", "machine", "bucket"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }},
+    ]
+
+async def backfill(db, company_lab: str = None, machine: str = None):
+    from index_manager import SENSOR_COLLECTION_PATTERN
+
+    # 重建會直接取代 bucket，server 記憶體裡還沒 flush 的增量之後再 $inc 上去就重複計算
+    now = datetime.utcnow()
+    writers = await db[ROLLUP_WRITERS_COLLECTION].find({}).to_list(None)
+    live = [writer for writer in writers if not writer_crashed(writer, now)]
+    if live:
+        hosts = ", ".join(f"{writer.get('host')}:{writer.get('pid')}" for writer in live)
+        raise RuntimeError(f"server 正在寫入 rollup ({hosts})，請先停止 server 再重建")
+
+    # $merge 的 on 欄位需要 unique 索引
+    for resolution in ROLLUP_RESOLUTIONS:
+        await db[rollup_collection_name(resolution)].create_index(
+            [("company_lab", 1), ("machine", 1), ("bucket", 1)], unique=True
+        )
+
+    names = sorted(n for n in await db.list_collection_names() if SENSOR_COLLECTION_PATTERN.match(n))
+    rebuilt: Dict[Tuple[str, str], List[datetime]] = {}
+    for name in names:
+        prefix = name.rsplit("-", 2)[0]
+        coll_company_lab, coll_machine = prefix.split("-", 1)
+        if company_lab and coll_company_lab != company_lab:
+            continue
+        if machine and coll_machine != machine:
+            continue
+        for resolution, (_, unit) in ROLLUP_RESOLUTIONS.items():
+            pipeline = build_backfill_pipeline(coll_company_lab, coll_machine, unit, resolution)
+            await db[name].aggregate(pipeline, allowDiskUse=True).to_list(None)
+        latest = await db[name].find_one({}, {"timestamp": 1}, sort=[("timestamp", -1)])
+        rebuilt.setdefault((coll_company_lab, coll_machine), [])
+        if latest:
+            rebuilt[(coll_company_lab, coll_machine)].append(latest["timestamp"])
+        print(f"rollup 重建完成: {name}")
+
+    # 重建過的機台從頭開始都算完整，原本的 gap 也一併清掉
+    for (coll_company_lab, coll_machine), latest in rebuilt.items():
+        update = {"$set": {"start": COVERAGE_ALL}}
+        if latest:
+            update["$max"] = {"flushed": max(latest)}
+        await db[ROLLUP_STATE_COLLECTION].update_one({"company_lab": coll_company_lab, "machine": coll_machine}, update, upsert=True)
+        await db[ROLLUP_GAPS_COLLECTION].delete_many({"company_lab": coll_company_lab, "machine": coll_machine})
+    if not company_lab and not machine:
+        # 全部重建過，之前沒正常關機遺失的增量也補回來了
+        await db[ROLLUP_WRITERS_COLLECTION].delete_many({"_id": {"$in": [writer["_id"] for writer in writers]}})
+
+if __name__ == "__main__":
+    import motor.motor_asyncio
+    from run import load_env
+
+    parser = argparse.ArgumentParser(description="Rebuild 1-minute / 1-hour rollups from the monthly collections.")
+    parser.add_argument("--prod",action="store_true", help="Use the production settings.")
+    parser.add_argument("--dev",action="store_true", help="Use the development settings.")
+    parser.add_argument("--company-lab", default=None, help="Only rebuild this company_lab.")
+    parser.add_argument("--machine", default=None, help="Only rebuild this machine.")
+    args = parser.parse_args()
+    load_env(args)
+
+    client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://localhost:27017/")
+    try:
+        asyncio.run(backfill(client[os.getenv("DATABASE_URL")], args.company_lab, args.machine))
+    except RuntimeError as e:
+        raise SystemExit(str(e))
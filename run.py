@@ -1,21 +1,78 @@
 import argparse
+import importlib.util
 import os
+from multiprocessing import Process
 from dotenv import load_dotenv
 import uvicorn
 
-#設定指令
-if __name__ == "__main__":
-
+def build_parser():
     parser = argparse.ArgumentParser(description="Run the server in different modes.")
     parser.add_argument("--prod",action="store_true", help="Run the server in production mode.")
     parser.add_argument("--dev",action="store_true", help="Run the server in development mode.")
-    
-    args = parser.parse_args()
-    
+    parser.add_argument("--host", default=None, help="Bind host (default: HOST or 127.0.0.1).")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes in production mode (default: WORKERS or CPU count).")
+    parser.add_argument("--backlog", type=int, default=None, help="Listen backlog (default: BACKLOG or 2048).")
+    parser.add_argument("--keep-alive", type=int, default=None, help="Keep-alive timeout in seconds (default: KEEP_ALIVE or 5).")
+    parser.add_argument("--graceful-timeout", type=int, default=None, help="Seconds to drain connections on SIGTERM (default: GRACEFUL_TIMEOUT or 30).")
+    return parser
+
+def load_env(args):
     if args.prod:
         load_dotenv("setting/.env.prod")
     else:
         load_dotenv("setting/.env.dev")
 
-    
-    uvicorn.run("server:app", host="127.0.0.1" , port=int(os.getenv("PORT")) , reload=True )
\ No newline at end of file
+#有裝 uvloop / httptools 就用，沒有就退回預設實作
+def select_loop():
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+def select_http():
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+def run_broker(path):
+    import asyncio
+    from broadcast_bus import run_broker as broker_main
+    asyncio.run(broker_main(path))
+
+def serve(args):
+    host = args.host or os.getenv("HOST", "127.0.0.1")
+    port = int(os.getenv("PORT"))
+
+    if not args.prod:
+        # dev mode：單一 process + reload
+        uvicorn.run("server:app", host=host, port=port, reload=True)
+        return
+
+    workers = args.workers or int(os.getenv("WORKERS", "0")) or os.cpu_count() or 1
+    broker = None
+    if workers > 1 and os.getenv("BROADCAST_BACKEND", "memory") == "memory":
+        # 多個 worker 需要跨 process 廣播，自動啟動 broker
+        os.environ["BROADCAST_BACKEND"] = "unix"
+        os.environ.setdefault("BROADCAST_SOCKET", "/tmp/iot-backend-bus.sock")
+        broker = Process(target=run_broker, args=(os.environ["BROADCAST_SOCKET"],), daemon=True)
+        broker.start()
+
+    try:
+        # uvicorn 收到 SIGTERM 會停止接新連線，等既有請求完成 (最多 graceful timeout 秒)
+        uvicorn.run(
+            "server:app",
+            host=host,
+            port=port,
+            reload=False,
+            workers=workers,
+            loop=select_loop(),
+            http=select_http(),
+            backlog=args.backlog or int(os.getenv("BACKLOG", "2048")),
+            timeout_keep_alive=args.keep_alive or int(os.getenv("KEEP_ALIVE", "5")),
+            timeout_graceful_shutdown=args.graceful_timeout or int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+        )
+    finally:
+        if broker is not None:
+            broker.terminate()
+            broker.join()
+
+#設定指令
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    load_env(args)
+    serve(args)
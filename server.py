@@ -4,26 +4,43 @@ from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import motor.motor_asyncio
 import os
-import io
-from pydantic import BaseModel
-import bcrypt
+from pydantic import BaseModel, Field, AliasChoices
 from token_utils import create_access_token, create_refresh_token,decode_access_token, decode_refresh_token
-from depend import get_current_user
+from depend import get_current_user, get_current_account
+from user_cache import user_cache
+from password_pool import PasswordPool
+from http_client import create_http_client, LINE_API_HOST
+from line_webhook import WebhookProcessor
+from machine_frames import negotiate_format, decode_frame, receive_frame
+from bulk_ingest import BulkIngest, iter_ndjson_lines, parse_line
 from datetime import datetime, timedelta
 import json
-from typing import List, Optional,Dict
+import asyncio
+from typing import Optional,Dict,Union
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from starlette.websockets import WebSocketDisconnect
 from dateutil.relativedelta import relativedelta
-import openpyxl
-from linebot import LineBotApi,WebhookHandler
-from linebot.models import TextSendMessage
+from linebot import WebhookHandler
 import random, string, time
 import httpx
 import base64
 import hmac
 import hashlib
 from uuid import uuid4
+from ingest_writer import IngestWriter
+from ingest_spool import IngestSpool
+from threshold_cache import ThresholdCache
+from alert_dispatcher import AlertDispatcher
+from alert_state import AlertStateTracker
+from broadcast_bus import create_bus
+from export_utils import EXPORTERS, MEDIA_TYPES
+from index_manager import IndexManager
+from collection_catalog import CollectionCatalog
+from recent_buffer import RecentBuffer
+from rollup import RollupWriter, build_rollup_pipeline, pick_rollup, rollup_collection_name
+from query_utils import (merge_sorted_cursors, monthly_collection_names, parse_bucket, build_bucket_pipeline,
+                         bucket_doc_to_result, SENSOR_PROJECTION, SEARCH_BATCH_SIZE, AGGREGATE_MAX_BUCKETS, METRIC_PATTERN)
 #datatype
 class user_info(BaseModel):
     account:str
@@ -39,6 +56,10 @@ class login_info(BaseModel):
 class refresh_info(BaseModel):
     refresh_token:str
 
+class logout_info(BaseModel):
+    refresh_token:str
+    all_devices:bool = False
+
 class modified_info(BaseModel):
     account:str
     func_permissions:list[str]
@@ -53,8 +74,8 @@ class user_data(BaseModel):
 
 class sensor_data(BaseModel):
     machine:str
-    timestamp:str
-    value:dict
+    timestamp:Union[str,int,float]
+    values:dict = Field(validation_alias=AliasChoices("values", "value"))
 
 class sensor_info(BaseModel):
     name:str
@@ -114,6 +135,11 @@ class company_info(BaseModel):
 class machine_company(BaseModel):
     company:str
     machine:str
+
+class machines_control_info(BaseModel):
+    company:str
+    machines:list[str]
+    action:str
   
 #連DB
 client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://localhost:27017/")
@@ -124,7 +150,7 @@ def generate_binding_code():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
 async def reply_line_message(reply_token: str, message: str):
-    url = "https://api.line.me/v2/bot/message/reply"
+    url = f"{LINE_API_HOST}/v2/bot/message/reply"
     headers = {
         "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
         "Content-Type": "application/json"
@@ -133,10 +159,40 @@ async def reply_line_message(reply_token: str, message: str):
         "replyToken": reply_token,
         "messages": [{"type": "text", "text": message}]
     }
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(url, headers=headers, json=payload)
-        resp.raise_for_status()
-        return resp.json()
+    resp = await http_client.post(url, headers=headers, json=payload)
+    resp.raise_for_status()
+    return resp.json()
+
+async def revoke_account_tokens(account: str):
+    # 一次撤銷該帳號所有尚未撤銷的 refresh token
+    result = await refresh_tokens_collection.update_many(
+        {"account": account, "revoked": False},
+        {"$set": {"revoked": True, "revoked_at": datetime.utcnow()}}
+    )
+    return result.modified_count
+
+MACHINE_CONTROL_CONCURRENCY = int(os.getenv("MACHINE_CONTROL_CONCURRENCY", "10"))
+MACHINE_CONTROL_TIMEOUT = float(os.getenv("MACHINE_CONTROL_TIMEOUT", "5"))
+MACHINE_CONTROL_MAX = int(os.getenv("MACHINE_CONTROL_MAX", "200"))
+machine_control_limits: Dict[str, asyncio.Semaphore] = {}
+
+#單台 (/api/machineOn、/api/machineOff) 與批次 (/api/machinesControl) 都走這裡
+#POST {company IP}/on 或 /off，body 為 {"machine": <machine 名稱>}，controller 依 machine 欄位決定控制哪一台
+async def send_machine_command(company: str, address: str, machine: str):
+    # 每間公司同時送出的指令有上限，每台機器各自 timeout
+    semaphore = machine_control_limits.setdefault(company, asyncio.Semaphore(MACHINE_CONTROL_CONCURRENCY))
+    async with semaphore:
+        try:
+            response = await asyncio.wait_for(http_client.post(address, json={"machine": machine}), MACHINE_CONTROL_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {"ok": False, "error": "timeout"}
+        except httpx.HTTPError as e:
+            return {"ok": False, "error": str(e) or type(e).__name__}
+    try:
+        body = response.json()
+    except ValueError:
+        body = response.text
+    return {"ok": response.is_success, "status": response.status_code, "response": body}
 
 def verify_line_signature(body: bytes, signature: str) -> bool: 
     hash = hmac.new(
@@ -147,58 +203,118 @@ def verify_line_signature(body: bytes, signature: str) -> bool:
     calculated_signature = base64.b64encode(hash).decode()
     return hmac.compare_digest(calculated_signature, signature)
 
-def analyze_data(data, thresholds):
-    report = {}
-
-    for key, value in data.items():
-        limit = thresholds.get(key)
-        if not limit:
-            continue
-        minv = limit.get("min")
-        maxv = limit.get("max")
-
-        if minv is not None and value < minv:
-            report[key] = f"{key} 過低 ({value})"
-        elif maxv is not None and value > maxv:
-            report[key] = f"{key} 過高 ({value})"
-        
-    return report
-
-def format_alert(report, company_lab, sensor):
-    alerts = [f"{v}" for  v in report.items()]
+def format_alert(report, company_lab, sensor, machine):
+    alerts = [f"{v}" for  v in report.values()]
     
     if not alerts:
         return None
-    return f"【{company_lab} - {sensor}】偵測到異常\n" + "\n".join(alerts)
+    return f"【{company_lab} - {sensor} - {machine}】偵測到異常\n" + "\n".join(alerts)
+
+def format_recovery(report, company_lab, sensor, machine):
+    recoveries = [f"{v}" for v in report.values()]
+
+    if not recoveries:
+        return None
+    return f"【{company_lab} - {sensor} - {machine}】已恢復正常\n" + "\n".join(recoveries)
+
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_MAX_DROPPED = int(os.getenv("WS_MAX_DROPPED", "500"))
 
+#每個 client 一個傳送佇列 + writer task，慢的 client 不會拖住其他人
+class ClientConnection:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.dropped = 0
+        self.task = None
 
+#廣播經過 bus (單 process 或跨 process)，收到後再分送給本 process 的 client
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+    def __init__(self, bus):
+        self.bus = bus
+        self.active_connections: Dict[str, Dict[WebSocket, ClientConnection]] = {}
+        self._tasks = set()
+
+    async def start(self):
+        await self.bus.start(self.deliver)
+
+    async def stop(self):
+        await self.bus.stop()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
 
     async def connect(self, websocket: WebSocket, company_lab: str):
+        client = ClientConnection(websocket)
         if company_lab not in self.active_connections:
-            self.active_connections[company_lab] = []
-        self.active_connections[company_lab].append(websocket)
+            self.active_connections[company_lab] = {}
+            self.bus.subscribe(company_lab)
+        self.active_connections[company_lab][websocket] = client
+        client.task = asyncio.create_task(self._writer(client, company_lab))
 
     def disconnect(self, websocket: WebSocket, company_lab: str):
-        if company_lab in self.active_connections:
-            if websocket in self.active_connections[company_lab]:
-                self.active_connections[company_lab].remove(websocket)
-            if not self.active_connections[company_lab]:
-                del self.active_connections[company_lab]
+        connections = self.active_connections.get(company_lab)
+        if connections is None:
+            return
+        client = connections.pop(websocket, None)
+        if client and client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
+        if not connections:
+            del self.active_connections[company_lab]
+            self.bus.unsubscribe(company_lab)
+
+    async def _writer(self, client: ClientConnection, company_lab: str):
+        try:
+            while True:
+                text = await client.queue.get()
+                await asyncio.wait_for(client.websocket.send_text(text), WS_SEND_TIMEOUT)
+                if client.queue.empty():
+                    client.dropped = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 送不出去也要關掉連線，不然 client 的 receive loop 會一直卡著
+            self._drop(client, company_lab)
 
     async def broadcast(self, message: dict, target_machine: str):
-        if target_machine not in self.active_connections:
+        if self.bus.local and target_machine not in self.active_connections:
             return
-        dead_sockets = []
-        for connection in self.active_connections[target_machine]:
-            try:
-                await connection.send_json(message)
-            except Exception:
-                dead_sockets.append(connection)
-        for ws in dead_sockets:
-            self.disconnect(ws, target_machine)
+        # 只序列化一次
+        text = json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+        await self.bus.publish(target_machine, text)
+
+    def deliver(self, target_machine: str, text: str):
+        connections = self.active_connections.get(target_machine)
+        if not connections:
+            return
+        slow_clients = []
+        for client in connections.values():
+            if client.queue.full():
+                # 佇列滿了就丟掉最舊的一筆，只保留最新資料
+                client.queue.get_nowait()
+                client.dropped += 1
+                if client.dropped >= WS_MAX_DROPPED:
+                    slow_clients.append(client)
+                    continue
+            client.queue.put_nowait(text)
+        for client in slow_clients:
+            print(f"WebSocket client 過慢，中斷連線 ({target_machine})")
+            self._drop(client, target_machine)
+
+    def _drop(self, client: ClientConnection, company_lab: str):
+        self.disconnect(client.websocket, company_lab)
+        # 保留 task 參考，避免還沒關完就被 GC
+        task = asyncio.create_task(self._close(client.websocket))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=1013), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
 
 #token
 MACHINE_KEYS: Dict[str, str] = json.loads(os.getenv("MACHINE_KEYS", "{}"))
@@ -206,9 +322,8 @@ LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 
 #module
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
-manager = ConnectionManager()
+manager = ConnectionManager(create_bus())
 
 #collection
 company_collection = db["company"]
@@ -218,31 +333,73 @@ line_subscriber_collection=db["line_subscriber"]
 thresholds_collection=db["thresholds"]
 collection = db["plc"]
 refresh_tokens_collection = db["refresh_tokens"]
+user_cache.bind(user_collection)
+alert_dead_letter_collection = db["alert_dead_letter"]
+
+index_manager = IndexManager(db)
+collection_catalog = CollectionCatalog(db)
+ingest_spool = IngestSpool()
+ingest_writer = IngestWriter(db, index_manager, collection_catalog, ingest_spool)
+rollup_writer = RollupWriter(db)
+recent_buffer = RecentBuffer(db)
+password_pool = PasswordPool()
+http_client: httpx.AsyncClient = None
+webhook_processor = WebhookProcessor(line_subscriber_collection, reply_line_message)
+threshold_cache = ThresholdCache(thresholds_collection)
+alert_state = AlertStateTracker()
+alert_dispatcher = AlertDispatcher(line_subscriber_collection, alert_dead_letter_collection, LINE_CHANNEL_ACCESS_TOKEN)
 # todo: controlMachine
 #auth
 func_auth = ["create_user","modify_user","get_users","modify_lab","get_labs","view_data","control_machine","change_password"]
 extra_func_auth = ["set_thresholds","modify_notification"]
 
+async def seed_superuser():
+    # 多個 worker 會同時啟動：在 user.account unique 索引建立後才用 upsert 建立，只會有一筆
+    if await user_collection.find_one():
+        return
+    account = os.getenv("SUPERUSER_ACCOUNT")
+    result = {
+        "password": await password_pool.hash(os.getenv("SUPERUSER_PASSWORD")),
+        "func_permissions": ["superuser",],
+        "company": "super",
+        "lab":"super",
+        "allow_notify":True,
+        "update_time": datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
+        "delete_time": ""
+    }
+    try:
+        await user_collection.update_one({"account": account}, {"$setOnInsert": result}, upsert=True)
+    except DuplicateKeyError:
+        # 別的 worker 同時 upsert 成功了
+        pass
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    superuser = await user_collection.find_one()
-    if not superuser:
-        result = {
-            "account": os.getenv("SUPERUSER_ACCOUNT"),
-            "password": bcrypt.hashpw(os.getenv("SUPERUSER_PASSWORD").encode("utf-8"), bcrypt.gensalt()),
-            "func_permissions": ["superuser",],
-            "company": "super",
-            "lab":"super",
-            "allow_notify":True,
-            "update_time": datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
-            "delete_time": ""
-        }
-        await user_collection.insert_one(result)
-        await refresh_tokens_collection.create_index(
-        "expires_at",
-        expireAfterSeconds=0
-    )
+    global http_client
+    http_client = create_http_client()
+    await collection_catalog.load()
+    collection_catalog.start()
+    await index_manager.startup(list(collection_catalog.names))
+    await seed_superuser()
+    await threshold_cache.load()
+    threshold_cache.start()
+    await manager.start()
+    ingest_writer.start()
+    rollup_writer.start()
+    alert_dispatcher.start(http_client)
+    webhook_processor.start()
     yield
+    await webhook_processor.stop()
+    await index_manager.stop()
+    await manager.stop()
+    await ingest_writer.stop()
+    await rollup_writer.stop()
+    await recent_buffer.stop()
+    await alert_dispatcher.stop()
+    await threshold_cache.stop()
+    await collection_catalog.stop()
+    password_pool.shutdown()
+    await http_client.aclose()
     
     
 app = FastAPI(lifespan=lifespan)
@@ -266,13 +423,27 @@ app.add_middleware(
 async def DB_test():
     return "Success"
 
+@app.get("/api/metrics")
+async def get_metrics(account=Depends(get_current_account)):
+    if not "superuser" in account["func_permissions"]:
+        raise HTTPException(status_code=401, detail="權限不足")
+    return {
+        "user_cache": user_cache.stats,
+        "ingest": ingest_writer.stats,
+        "spool": ingest_spool.stats,
+        "rollup": rollup_writer.stats,
+        "recent_buffer": recent_buffer.stats,
+        "alerts": alert_dispatcher.stats,
+        "password_pool": password_pool.stats,
+        "webhook": webhook_processor.stats,
+    }
+
 @app.get("/api/protected")
 async def protected_route(user=Depends(get_current_user)):
     return {"message": "Hello!", "user": user}
 
 @app.post("/api/manageCompany")
-async def manage_company(info:company_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def manage_company(info:company_info,account=Depends(get_current_account)):
     if not "superuser" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
     company_in_db = await company_collection.find_one({"company": info.company})
@@ -286,8 +457,7 @@ async def manage_company(info:company_info,auth=Depends(get_current_user)):
         return {"message": "修改成功"}
     
 @app.post("/api/deleteCompany")
-async def delete_company(info:company_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def delete_company(info:company_info,account=Depends(get_current_account)):
     if not "superuser" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
     company_in_db = await company_collection.find_one({"company": info.company})
@@ -308,8 +478,7 @@ async def get_company():
     return result
 
 @app.get("/api/getCompanyByName")
-async def get_company_by_name(company:str,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def get_company_by_name(company:str,account=Depends(get_current_account)):
     if not "superuser" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
     company_in_db = await company_collection.find_one({"company": company})
@@ -319,8 +488,7 @@ async def get_company_by_name(company:str,auth=Depends(get_current_user)):
     return {"company": company_in_db["company"],"extra_auth":company_in_db["extra_auth"],"IP":company_in_db["IP"]}
 
 @app.post("/api/createUser")
-async def create_user(user:user_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def create_user(user:user_info,account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "create_user" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
@@ -345,8 +513,9 @@ async def create_user(user:user_info,auth=Depends(get_current_user)):
                 raise HTTPException(status_code=401, detail="權限格式錯誤")
         
     
-    result = {"account":user.account,"password":bcrypt.hashpw(user.password.encode("utf-8"), bcrypt.gensalt()),"func_permissions":user.func_permissions,"company":user.company,"lab":user.lab,"allow_notify":False,"update_time":datetime.now().strftime("%Y/%m/%d %H:%M:%S"),"delete_time":""}
+    result = {"account":user.account,"password":await password_pool.hash(user.password),"func_permissions":user.func_permissions,"company":user.company,"lab":user.lab,"allow_notify":False,"update_time":datetime.now().strftime("%Y/%m/%d %H:%M:%S"),"delete_time":""}
     await user_collection.insert_one(result)
+    user_cache.invalidate(user.account)
     return {"message": "新增成功"}
 
 @app.post("/api/login")
@@ -360,7 +529,7 @@ async def login(user:login_info):
         raise HTTPException(status_code=401, detail="帳密錯誤")
 
     # 檢查密碼
-    if not bcrypt.checkpw(user.password.encode("utf-8"), user_in_db["password"]):
+    if not await password_pool.check(user.password, user_in_db["password"]):
         raise HTTPException(status_code=401, detail="帳密錯誤")
     
     # 產生 JWT token
@@ -384,24 +553,28 @@ async def refresh(refresh:refresh_info):
     jti = payload["jti"]
     account = payload["account"]
 
-    # lookup stored token by jti & account
-    refresh_token_in_db = await refresh_tokens_collection.find_one({"jti": jti, "account": account})
-    
+    now = datetime.utcnow()
+    token_hash = hashlib.sha256(refresh.refresh_token.encode("utf-8")).hexdigest()
+
+    # Rotation: 單一條件更新，只有未撤銷、未過期且 hash 相符的 token 會被撤銷換新 (同時多個分頁 refresh 只有一個成功)
+    refresh_token_in_db = await refresh_tokens_collection.find_one_and_update(
+        {"jti": jti, "account": account, "token_hash": token_hash, "revoked": False, "expires_at": {"$gt": now}},
+        {"$set": {"revoked": True, "revoked_at": now}},
+        projection={"_id": 1}
+    )
+
     if not refresh_token_in_db:
-        raise HTTPException(status_code=401, detail="token 錯誤")
-
-    # check revoked & expiry & hash
-    if refresh_token_in_db["revoked"]:
-        raise HTTPException(status_code=401, detail="Refresh token revoked")
-    if refresh_token_in_db["expires_at"] and refresh_token_in_db["expires_at"] < datetime.utcnow():
-        raise HTTPException(status_code=401, detail="Refresh token expired")
-    if refresh_token_in_db["token_hash"] != hashlib.sha256(refresh.refresh_token.encode("utf-8")).hexdigest():
-        await refresh_tokens_collection.update_one({"_id": refresh_token_in_db["_id"]}, {"$set": {"revoked": True}})
+        # 失敗時才再查一次，判斷原因
+        refresh_token_in_db = await refresh_tokens_collection.find_one({"jti": jti, "account": account})
+        if not refresh_token_in_db:
+            raise HTTPException(status_code=401, detail="token 錯誤")
+        if refresh_token_in_db["revoked"]:
+            raise HTTPException(status_code=401, detail="Refresh token revoked")
+        if refresh_token_in_db["expires_at"] and refresh_token_in_db["expires_at"] < now:
+            raise HTTPException(status_code=401, detail="Refresh token expired")
+        await refresh_tokens_collection.update_one({"_id": refresh_token_in_db["_id"]}, {"$set": {"revoked": True, "revoked_at": now}})
         raise HTTPException(status_code=401, detail="Refresh token invalid")
 
-    # Rotation: revoke old token and create new refresh token & new DB record
-    await refresh_tokens_collection.update_one({"_id": refresh_token_in_db["_id"]}, {"$set": {"revoked": True, "revoked_at": datetime.utcnow()}})
-
     new_refresh_token,new_jti = create_refresh_token({"account": account})
     new_hash = hashlib.sha256(new_refresh_token.encode("utf-8")).hexdigest()
     new_expires = datetime.utcnow() + timedelta(days=int(os.getenv("REFRESH_EXPIRE_DAYS")))
@@ -420,21 +593,22 @@ async def refresh(refresh:refresh_info):
     return {"access_token": new_access, "refresh_token": new_refresh_token}
 
 @app.post("/api/logout")
-async def logout(refresh:refresh_info):    
+async def logout(refresh:logout_info):    
     payload = decode_refresh_token(refresh.refresh_token)
     jti = payload["jti"]
     account = payload["account"]
     
-    refresh_token_in_db = await refresh_tokens_collection.find_one({"jti": jti, "account": account})
-    if not refresh_token_in_db:
+    result = await refresh_tokens_collection.update_one({"jti": jti, "account": account}, {"$set": {"revoked": True, "revoked_at": datetime.utcnow()}})
+    if not result.matched_count:
         raise HTTPException(status_code=404, detail="Refresh token not found")
 
-    await refresh_tokens_collection.update_one({"_id": refresh_token_in_db["_id"]}, {"$set": {"revoked": True, "revoked_at": datetime.utcnow()}})
+    # 登出所有裝置
+    if refresh.all_devices:
+        await revoke_account_tokens(account)
     return {"message": "success"}
 
 @app.post("/api/modifyPermissions")
-async def modify_permissions(info:modified_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def modify_permissions(info:modified_info,account=Depends(get_current_account)):
     company_auth = await company_collection.find_one({"company":info.company})
 
     if not "superuser" in account["func_permissions"] and not "modify_user" in account["func_permissions"]:
@@ -458,11 +632,11 @@ async def modify_permissions(info:modified_info,auth=Depends(get_current_user)):
             raise HTTPException(status_code=401, detail="權限不足")
         await user_collection.update_one({"account":info.account},{"$set":{"func_permissions":info.func_permissions,"lab":info.lab,"allow_notify":info.allow_notify,"update_time":datetime.now().strftime("%Y/%m/%d %H:%M:%S")}})
     
+    user_cache.invalidate(info.account)
     return {"message": "修改成功"}
     
 @app.get("/api/getUsers")
-async def get_users(auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def get_users(account=Depends(get_current_account)):
     result = []
 
     if not "superuser" in account["func_permissions"] and not "get_users" in account["func_permissions"]:
@@ -487,19 +661,19 @@ async def get_users(auth=Depends(get_current_user)):
         return result
 
 @app.post("/api/deleteUser")
-async def delete_user(userinfo:delete_user_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def delete_user(userinfo:delete_user_info,account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "modify_user" in account["func_permissions"]:
             raise HTTPException(status_code=401, detail="權限不足")
     
     await user_collection.update_one({"account":userinfo.account},{"$set":{"delete_time":datetime.now().strftime("%Y/%m/%d %H:%M:%S")}})
+    user_cache.invalidate(userinfo.account)
+    await revoke_account_tokens(userinfo.account)
     
     return {"message": "刪除成功"} 
        
 @app.post("/api/createLab")
-async def create_lab(lab:lab_data,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def create_lab(lab:lab_data,account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "modify_lab" in account["func_permissions"]:
             raise HTTPException(status_code=401, detail="權限不足")
@@ -514,8 +688,7 @@ async def create_lab(lab:lab_data,auth=Depends(get_current_user)):
     return {"message": "新增成功"}
 
 @app.get("/api/getLabs")
-async def get_labs(auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def get_labs(account=Depends(get_current_account)):
     result = []
 
     if not "superuser" in account["func_permissions"] and not "get_labs" in account["func_permissions"]:
@@ -538,8 +711,7 @@ async def get_labs(auth=Depends(get_current_user)):
         return result
 
 @app.post("/api/modifyLab")
-async def modify_lab(lab:lab_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def modify_lab(lab:lab_info,account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "modify_lab" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
@@ -551,8 +723,7 @@ async def modify_lab(lab:lab_info,auth=Depends(get_current_user)):
     return {"message": "修改成功"}
 
 @app.post("/api/deleteLab")
-async def delete_lab(lab:delete_lab_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def delete_lab(lab:delete_lab_info,account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "modify_lab" in account["func_permissions"]:
             raise HTTPException(status_code=401, detail="權限不足")
@@ -567,7 +738,8 @@ async def search_data(
     machine: str,
     start: str ,
     end: str,
-    auth=Depends(get_current_user)
+    file_format: str = Query("xlsx", alias="format"),
+    account=Depends(get_current_account)
 ):
     try:
         start_dt = datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
@@ -578,76 +750,47 @@ async def search_data(
     if end_dt < start_dt:
         raise HTTPException(status_code=400, detail="結束時間不可早於開始時間")
 
+    if file_format not in EXPORTERS:
+        raise HTTPException(status_code=400, detail="格式錯誤，應為 xlsx、csv 或 ndjson")
+
     # 確認權限
-    account = await user_collection.find_one({"account": auth["account"]})
-    
     if not "superuser" in account["func_permissions"] and not "view_data" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
 
-    # 找對應的 collection
-    collections_to_query = []
-    current = datetime(start_dt.year, start_dt.month, 1)
-    while current <= end_dt:
-        collections_to_query.append(f"{company_lab}-{machine}-{current.year}-{current.month}")
-        current += relativedelta(months=1)
-
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "SensorData"
-    headers = ["timestamp", "machine", "temperature", "humidity", "pm25", "pm10", 
-               "pm25_average", "pm10_average", "co2", "tvoc"]
-    ws.append(headers)
-
-    total_records = 0
-
-    # === 查詢每個月的 collection ===
-    existing_collections = await db.list_collection_names()  # 預先取一次避免多次 I/O
-    for collection_name in collections_to_query:
-        if collection_name not in existing_collections:
-            continue  # 沒有該月份的 collection 就略過
-        
-        collection = db[collection_name]
-        cursor = collection.find({
-            "timestamp": {
-                "$gte": start_dt,
-                "$lte": end_dt
-            }
-        })
-
-        async for doc in cursor:
-            ts = (doc["timestamp"].strftime("%Y-%m-%d %H:%M:%S") 
-                  if isinstance(doc["timestamp"], datetime) else doc["timestamp"])
-            values = doc.get("values", {})
-            row = [
-                ts,
-                doc.get("machine", ""),
-                values.get("temperature", ""),
-                values.get("humidity", ""),
-                values.get("pm25", ""),
-                values.get("pm10", ""),
-                values.get("pm25_average", ""),
-                values.get("pm10_average", ""),
-                values.get("co2", ""),
-                values.get("tvoc", ""),
-            ]
-            ws.append(row)
-            total_records += 1
+    # 找對應的 collection，沒有該月份的 collection 就略過
+    collections_to_query = [
+        name for name in monthly_collection_names(company_lab, machine, start_dt, end_dt)
+        if await collection_catalog.exists(name)
+    ]
+
+    # === 同時查詢每個月的 collection，依 timestamp 合併 (逐批從 cursor 讀出，不整份放記憶體) ===
+    cursors = [
+        db[collection_name].find(
+            {"timestamp": {"$gte": start_dt, "$lte": end_dt}},
+            SENSOR_PROJECTION,
+            batch_size=SEARCH_BATCH_SIZE
+        ).sort("timestamp", 1)
+        for collection_name in collections_to_query
+    ]
+
+    docs = merge_sorted_cursors(cursors)
+    first_doc = await anext(docs, None)
 
     # === 無資料時回報 ===
-    if total_records == 0:
+    if first_doc is None:
         raise HTTPException(status_code=404, detail="查無符合條件的資料")
 
-    # === 匯出 ===
-    stream = io.BytesIO()
-    wb.save(stream)
-    stream.seek(0)
+    async def all_docs():
+        yield first_doc
+        async for doc in docs:
+            yield doc
 
-    filename = f"{company_lab}_{machine}_{start_dt.strftime('%Y%m%d')}_{end_dt.strftime('%Y%m%d')}.xlsx"
-    
+    # === 匯出 ===
+    filename = f"{company_lab}_{machine}_{start_dt.strftime('%Y%m%d')}_{end_dt.strftime('%Y%m%d')}.{file_format}"
 
     return StreamingResponse(
-        stream,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        EXPORTERS[file_format](all_docs()),
+        media_type=MEDIA_TYPES[file_format],
         headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
     )
 
@@ -656,13 +799,18 @@ async def get_recent_data(
     company_lab: str ,
     machine: str ,
     number: int ,
-    auth=Depends(get_current_user)
+    account=Depends(get_current_account)
 ):
     
-    account = await user_collection.find_one({"account": auth["account"]})
     if not "superuser" in account["func_permissions"] and not "view_data" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
 
+    # 先從記憶體的 ring buffer 取，不夠才查 DB
+    results = recent_buffer.get(company_lab, machine, number)
+    if results is not None:
+        results.sort(key=lambda x: x["timestamp"])
+        return results
+
     now = datetime.utcnow()
     this_month = f"{company_lab}-{machine}-{now.year}-{now.month}"
     last_month_date = now - relativedelta(months=1)
@@ -671,14 +819,14 @@ async def get_recent_data(
     results = []
 
     
-    if this_month in await db.list_collection_names():
+    if await collection_catalog.exists(this_month):
         cursor = db[this_month].find().sort("timestamp", -1).limit(number)
         async for doc in cursor:
             doc["_id"] = str(doc["_id"])
             results.append(doc)
 
     
-    if len(results) < number and last_month in await db.list_collection_names():
+    if len(results) < number and await collection_catalog.exists(last_month):
         needed = number - len(results)
         cursor = db[last_month].find().sort("timestamp", -1).limit(needed)
         async for doc in cursor:
@@ -689,11 +837,75 @@ async def get_recent_data(
 
     return results
 
+@app.get("/api/aggregateData")
+async def aggregate_data(
+    company_lab: str,
+    machine: str,
+    start: str,
+    end: str,
+    bucket: str,
+    metrics: str,
+    percentiles: Optional[str] = None,
+    account=Depends(get_current_account)
+):
+    try:
+        start_dt = datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
+        end_dt = datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="時間格式錯誤，應為 YYYY-%m-%d %H:%M:%S")
+
+    if end_dt < start_dt:
+        raise HTTPException(status_code=400, detail="結束時間不可早於開始時間")
+
+    parsed_bucket = parse_bucket(bucket)
+    if not parsed_bucket:
+        raise HTTPException(status_code=400, detail="bucket 格式錯誤，例如 30s、5m、1h、1d")
+    unit, size, bucket_seconds = parsed_bucket
+    if (end_dt - start_dt).total_seconds() / bucket_seconds > AGGREGATE_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"分桶數量超過上限 {AGGREGATE_MAX_BUCKETS}")
+
+    metric_list = [m.strip() for m in metrics.split(",") if m.strip()]
+    if not metric_list or not all(METRIC_PATTERN.match(m) for m in metric_list):
+        raise HTTPException(status_code=400, detail="metrics 格式錯誤")
+
+    try:
+        percentile_list = [float(p) / 100 for p in percentiles.split(",") if p.strip()] if percentiles else []
+    except ValueError:
+        raise HTTPException(status_code=400, detail="percentiles 格式錯誤")
+    if not all(0 < p < 1 for p in percentile_list):
+        raise HTTPException(status_code=400, detail="percentiles 需介於 0 到 100")
+
+    # 確認權限
+    if not "superuser" in account["func_permissions"] and not "view_data" in account["func_permissions"]:
+        raise HTTPException(status_code=401, detail="權限不足")
+
+    results = []
+
+    # 範圍與 bucket 對齊 rollup 解析度且不需百分位數時，直接讀 rollup
+    resolution = None if percentile_list else pick_rollup(start_dt, end_dt, bucket_seconds)
+    if resolution and not await rollup_writer.covers(company_lab, machine, start_dt, end_dt, resolution):
+        # 部署前、flush 失敗或還沒寫入的範圍改查原始資料
+        resolution = None
+    if resolution:
+        pipeline = build_rollup_pipeline(company_lab, machine, start_dt, end_dt, unit, size, metric_list)
+        async for doc in db[rollup_collection_name(resolution)].aggregate(pipeline):
+            results.append(bucket_doc_to_result(doc, metric_list, percentile_list))
+        return {"bucket": bucket, "buckets": results}
+
+    collection_names = [name for name in monthly_collection_names(company_lab, machine, start_dt, end_dt) if await collection_catalog.exists(name)]
+    if not collection_names:
+        return {"bucket": bucket, "buckets": []}
+
+    pipeline = build_bucket_pipeline(collection_names, start_dt, end_dt, unit, size, metric_list, percentile_list)
+    async for doc in db[collection_names[0]].aggregate(pipeline, allowDiskUse=True):
+        results.append(bucket_doc_to_result(doc, metric_list, percentile_list))
+
+    return {"bucket": bucket, "buckets": results}
+
 @app.get("/api/getThresholds")
 async def get_thresholds(
     sensor: str ,company: str ,lab: str ,
-    auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+    account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "set_thresholds" in account["func_permissions"]:
             raise HTTPException(status_code=401, detail="權限不足")
@@ -709,8 +921,7 @@ async def get_thresholds(
     return {"company": company,"lab":lab,"sensor":sensor,"threshold":threshold_in_db["threshold"]}
     
 @app.post("/api/setThresholds")
-async def set_thresholds(info: threshold_data,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def set_thresholds(info: threshold_data,account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "set_thresholds" in account["func_permissions"]:
             raise HTTPException(status_code=401, detail="權限不足")
@@ -727,14 +938,15 @@ async def set_thresholds(info: threshold_data,auth=Depends(get_current_user)):
     threshold_in_db = await thresholds_collection.find_one({"company": info.company,"lab":info.lab,"sensor":info.sensor})
     if threshold_in_db:
         await thresholds_collection.update_one({"_id":threshold_in_db["_id"]}, {"$set":{"threshold":update_dict}}, upsert=True)
+        threshold_cache.set(info.company, info.lab, info.sensor, update_dict)
         return {"message": "修改成功"}
     else:    
         await thresholds_collection.insert_one({"company": info.company,"lab":info.lab,"sensor":info.sensor,"threshold":update_dict})
+        threshold_cache.set(info.company, info.lab, info.sensor, update_dict)
         return {"message": "新增成功"}
 
 @app.delete("/api/deleteThresholds")
-async def delete_thresholds(info: threshold_info,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def delete_thresholds(info: threshold_info,account=Depends(get_current_account)):
 
     if not "superuser" in account["func_permissions"] and not "set_thresholds" in account["func_permissions"]:
             raise HTTPException(status_code=401, detail="權限不足")
@@ -742,13 +954,14 @@ async def delete_thresholds(info: threshold_info,auth=Depends(get_current_user))
     threshold_in_db = await thresholds_collection.find_one({"company": info.company,"lab":info.lab,"sensor":info.sensor})
     if threshold_in_db:
         await thresholds_collection.delete_one({"_id":threshold_in_db["_id"]})
+        threshold_cache.invalidate(info.company, info.lab, info.sensor)
+        alert_state.clear(f"{info.company}_{info.lab}", info.sensor)
         return {"message": "刪除成功"}
     else:    
         return {"message": "查無資料"}
     
 @app.post("/api/generate_binding_code")
-async def generate_code(auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def generate_code(account=Depends(get_current_account)):
     if not account["allow_notify"]:
         raise HTTPException(status_code=401, detail="權限不足")
     line_subscriber_in_db = await line_subscriber_collection.find_one({"account":account["account"]})
@@ -779,51 +992,46 @@ async def webhook(request: Request):
     if not verify_line_signature(body_bytes, signature):
         raise HTTPException(status_code=400, detail="Invalid X-Line-Signature")
     
-    body = await request.json()
-    events = body.get("events", [])
-    for event in events:
-        if event.get("type") != "message":
-            continue
-        message = event.get("message", {})
-        if message.get("type") != "text":
-            continue
-
-        text = message.get("text", "").strip()
-        # replyToken 用來回覆
-        reply_token = event.get("replyToken")
-        # 取得 line user id
-        source = event.get("source", {})
-        line_user_id = source.get("userId")
-
-        if not text or not reply_token or not line_user_id:
-            # 忽略不完整事件
-            continue
-
-        now_ts = int(time.time())
-        
-        query = {
-            "binding_code": text,
-            "binding_expiry": {"$gt": now_ts}
-        }
-        
-        update = {
-            "$set": {"line_user_id": line_user_id},
-            "$unset": {"binding_code": "", "binding_expiry": ""}
-        }
-        user = await line_subscriber_collection.find_one_and_update(query, update)
-        if user:
-            # 綁定成功
-            username = user["account"]
-            await reply_line_message(reply_token, f"{username} 已完成 LINE 綁定！")
-        else:
-            await reply_line_message(reply_token, "綁定碼錯誤或已過期，請確認是否在網站產生新綁定碼。")
+    # 丟進背景佇列處理，馬上回應避免 LINE 重送
+    body = json.loads(body_bytes)
+    if webhook_processor.submit(body.get("events", [])):
+        # 佇列滿了：回非 200 讓 LINE 重送這批事件
+        raise HTTPException(status_code=503, detail="webhook 佇列已滿")
 
     # LINE 要求回 200
     return {"status": "ok"}
 
+@app.post("/api/ingestData")
+async def ingest_data(
+    request: Request,
+    company_lab: str,
+    api_key: str = Query(...)
+):
+    # 機台補資料，用和 WebSocket 上傳相同的 machine key 驗證
+    if MACHINE_KEYS.get(company_lab) != api_key:
+        raise HTTPException(status_code=401, detail="api_key 錯誤")
+
+    # NDJSON，每行一筆 {"machine", "timestamp", "values"}，可用 gzip 壓縮
+    compressed = (request.headers.get("Content-Encoding", "").lower() == "gzip"
+                  or "gzip" in request.headers.get("Content-Type", ""))
+    job = BulkIngest(db, index_manager, collection_catalog, rollup_writer)
+    try:
+        async for line_no, line in iter_ndjson_lines(request.stream(), compressed):
+            try:
+                doc = parse_line(line, sensor_data)
+            except ValueError as e:
+                job.reject(line_no, str(e))
+                continue
+            await job.add(company_lab, line_no, doc)
+    except ValueError as e:
+        # 資料流本身壞掉：已解析的部分照樣寫入並回報
+        report = await job.finish(company_lab)
+        raise HTTPException(status_code=400, detail={"error": str(e), **report})
+
+    return await job.finish(company_lab)
+
 @app.post("/api/machineOn")
-async def turn_on(target:machine_company,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def turn_on(target:machine_company,account=Depends(get_current_account)):
 
     if  not "control_machine" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
@@ -832,14 +1040,13 @@ async def turn_on(target:machine_company,auth=Depends(get_current_user)):
         raise HTTPException(status_code=401, detail="公司不一致")
     
     company = await company_collection.find_one({"company":target.company})
-    address = company["IP"] + "/on"
-    async with httpx.AsyncClient() as client:
-        response = await client.post(address)
-        return response.json()
+    result = await send_machine_command(target.company, company["IP"] + "/on", target.machine)
+    if not result["ok"]:
+        raise HTTPException(status_code=502, detail=result)
+    return result["response"]
     
 @app.post("/api/machineOff")
-async def turn_on(target:machine_company,auth=Depends(get_current_user)):
-    account = await user_collection.find_one({"account": auth["account"]})
+async def turn_off(target:machine_company,account=Depends(get_current_account)):
 
     if  not "control_machine" in account["func_permissions"]:
         raise HTTPException(status_code=401, detail="權限不足")
@@ -848,10 +1055,39 @@ async def turn_on(target:machine_company,auth=Depends(get_current_user)):
         raise HTTPException(status_code=401, detail="公司不一致")
     
     company = await company_collection.find_one({"company":target.company})
-    address = company["IP"] + "/off"
-    async with httpx.AsyncClient() as client:
-        response = await client.post(address)
-        return response.json()
+    result = await send_machine_command(target.company, company["IP"] + "/off", target.machine)
+    if not result["ok"]:
+        raise HTTPException(status_code=502, detail=result)
+    return result["response"]
+@app.post("/api/machinesControl")
+async def machines_control(target:machines_control_info,account=Depends(get_current_account)):
+    if  not "control_machine" in account["func_permissions"]:
+        raise HTTPException(status_code=401, detail="權限不足")
+    
+    if account["company"] != target.company:
+        raise HTTPException(status_code=401, detail="公司不一致")
+
+    if target.action not in ("on", "off"):
+        raise HTTPException(status_code=400, detail="action 應為 on 或 off")
+
+    machines = list(dict.fromkeys(target.machines))
+    if not machines:
+        raise HTTPException(status_code=400, detail="未指定機器")
+    if len(machines) > MACHINE_CONTROL_MAX:
+        raise HTTPException(status_code=400, detail=f"一次最多控制 {MACHINE_CONTROL_MAX} 台機器")
+
+    company = await company_collection.find_one({"company":target.company})
+    address = company["IP"] + "/" + target.action
+
+    # 同時送出，回傳每台機器的結果
+    results = await asyncio.gather(*[send_machine_command(target.company, address, machine) for machine in machines])
+    return {
+        "action": target.action,
+        "success": sum(1 for r in results if r["ok"]),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "results": dict(zip(machines, results))
+    }
+
 #socket
 @app.websocket("/ws/{company_lab}")
 async def websocket_endpoint(
@@ -859,7 +1095,8 @@ async def websocket_endpoint(
     company_lab: str,
     sensor:str,
     token: str = Query(None),
-    api_key: str = Query(None)
+    api_key: str = Query(None),
+    frame_format: str = Query(None, alias="format")
 ):
     # 判斷身份
     is_machine = api_key is not None and MACHINE_KEYS.get(company_lab) == api_key
@@ -873,7 +1110,7 @@ async def websocket_endpoint(
     if is_user:
         try:
             user = decode_access_token(token)
-            account = await user_collection.find_one({"account": user["account"]})
+            account = await user_cache.get(user["account"])
             user_company = account.get("company")
             if user_company != "super":
                 if user_company != company_lab.split("_")[0]:
@@ -884,63 +1121,74 @@ async def websocket_endpoint(
             await websocket.close(code=1008)
             return
 
+    # 機器端上傳格式在連線時決定
+    subprotocol = None
+    if is_machine:
+        frame_format, subprotocol = negotiate_format(frame_format, websocket.scope.get("subprotocols", []))
+        if frame_format is None:
+            await websocket.close(code=1003)  # Unsupported data
+            return
+
     # 成功才接受連線
-    await websocket.accept()
+    await websocket.accept(subprotocol=subprotocol)
     await manager.connect(websocket, company_lab)
+    machines_seen = set()
 
     try:
         while True:
-            data_str = await websocket.receive_text()
-            data = json.loads(data_str)
-            
-            if is_machine:
-                # 機器端上傳資料
-                try:
-                    ts_str = data.get("timestamp")
-                    if ts_str:
-                        timestamp = datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-                    else:
-                        timestamp = datetime.utcnow()
-                except Exception:
-                    timestamp = datetime.utcnow()
-
-                company,lab = company_lab.split("_")    
-
-                thresholds = await thresholds_collection.find_one({"company": company,"lab":lab,"sensor":sensor})
-                print(thresholds)
-                if thresholds:
-                    values = thresholds["threshold"]
-                    report = analyze_data(data.get("values"), values)
-                    alert_msg = format_alert(report, company_lab, sensor)
-                    print(alert_msg)
-                    
+            if not is_machine:
+                # 使用者端只接收廣播
+                await websocket.receive_text()
+                continue
+
+            # 機器端上傳資料，一個 frame 可能有多筆
+            payload = await receive_frame(websocket)
+            try:
+                readings = decode_frame(frame_format, payload)
+            except (ValueError, TypeError) as e:
+                print(f"無法解析資料 ({frame_format}): {e}")
+                continue
+
+            company,lab = company_lab.split("_")
+
+            # 同一個 frame 共用一次門檻值查詢
+            values = await threshold_cache.get(company, lab, sensor)
+            for reading in readings:
+                machine = reading["machine"]
+                timestamp = reading["timestamp"]
+
+                if values:
+                    # 只在進入/離開異常時通知，持續異常不重複推播
+                    fired, recovered = alert_state.evaluate(company_lab, sensor, machine, reading["values"], values)
+                    alert_msg = format_alert(fired, company_lab, sensor, machine)
+                    recovery_msg = format_recovery(recovered, company_lab, sensor, machine)
+
+                    # 丟進告警佇列，由背景 worker 推播
                     if alert_msg:
-                        subscribers = await line_subscriber_collection.find({"company": company,"lab":lab}).to_list(None)
-                        print(subscribers)
-                        for sub in subscribers:
-                            if "line_user_id" in sub and lab in sub["lab"]:
-                                try:
-                                    await line_bot_api.push_message(sub["line_user_id"], TextSendMessage(text=alert_msg))
-                                except Exception as e:
-                                    print(f"LINE 推播失敗: {e}")
-                    
+                        alert_dispatcher.submit(company, lab, alert_msg)
+                    if recovery_msg:
+                        alert_dispatcher.submit(company, lab, recovery_msg)
+
                 message = {
-                    "machine": data.get("machine"),
+                    "machine": machine,
                     "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                    "values": data.get("values")
+                    "values": reading["values"]
                 }
 
                 # 廣播資料
                 await manager.broadcast(message, target_machine=company_lab)
-                # 存入 MongoDB
-                now = datetime.utcnow()
-                collection_name = f"{company_lab}-{data['machine']}-{now.year}-{now.month}"
-                collection = db[collection_name]
-                await collection.insert_one({
+                # 存入 MongoDB (批次寫入)，依資料本身的時間分月份
+                collection_name = f"{company_lab}-{machine}-{timestamp.year}-{timestamp.month}"
+                doc = {
+                    "_id": ObjectId(),
                     "timestamp": timestamp,
-                    "machine": data["machine"],
-                    "values": data.get("values", {})
-                })
+                    "machine": machine,
+                    "values": reading["values"]
+                }
+                await ingest_writer.put(collection_name, doc)
+                recent_buffer.append(company_lab, machine, doc)
+                machines_seen.add(machine)
+                rollup_writer.add(company_lab, machine, timestamp, reading["values"])
 
     except WebSocketDisconnect as e:
         print(f"WebSocket 斷線 (code={e.code}, reason={e.reason})")
@@ -948,4 +1196,7 @@ async def websocket_endpoint(
     except Exception as e:
         print(f"WebSocket error: {e}")
         manager.disconnect(websocket, company_lab)
+    finally:
+        for machine in machines_seen:
+            recent_buffer.drop(company_lab, machine)
     
\ No newline at end of file
@@ -1,23 +1,10 @@
-import argparse
-import os
-from dotenv import load_dotenv
-import uvicorn
 from multiprocessing import Process
+from run import build_parser, load_env, serve
 #設定指令
-def run_uvicorn():
-    uvicorn.run("server:app", host="127.0.0.1" , port=int(os.getenv("PORT")) , reload=True )
 if __name__ == "__main__":
 
-    parser = argparse.ArgumentParser(description="Run the server in different modes.")
-    parser.add_argument("--prod",action="store_true", help="Run the server in production mode.")
-    parser.add_argument("--dev",action="store_true", help="Run the server in development mode.")
+    args = build_parser().parse_args()
+    load_env(args)
 
-    args = parser.parse_args()
-
-    if args.prod:
-        load_dotenv("setting/.env.prod")
-    else:
-        load_dotenv("setting/.env.dev")
-
-    p = Process(target=run_uvicorn)
-    p.start()
\ No newline at end of file
+    p = Process(target=serve, args=(args,))
+    p.start()
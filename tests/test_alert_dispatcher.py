@@ -0,0 +1,76 @@
+import asyncio
+import time
+import httpx
+import alert_dispatcher
+import line_stub
+from alert_dispatcher import AlertDispatcher, TokenBucket
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length=None):
+        return self.docs
+
+class FakeSubscribers:
+    def __init__(self, count: int):
+        self.docs = [{"line_user_id": f"U{i}", "lab": ["lab1"]} for i in range(count)]
+
+    def find(self, query, projection=None):
+        return FakeCursor(self.docs)
+
+class FakeDeadLetters:
+    def __init__(self):
+        self.docs = []
+
+    async def insert_one(self, doc):
+        self.docs.append(doc)
+
+async def dispatch(subscribers: int, failures=(), rate: int = 1000, max_retries: int = 3):
+    # 直接用 ASGI transport 打 line_stub，不需要真的開 port
+    dead_letters = FakeDeadLetters()
+    dispatcher = AlertDispatcher(FakeSubscribers(subscribers), dead_letters, "token", workers=1, max_retries=max_retries)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=line_stub.app)) as client:
+        await line_stub.reset_calls()
+        line_stub.app.state.rate = rate
+        for status, count in failures:
+            await line_stub.inject_failures(status, count)
+        dispatcher.start(client)
+        dispatcher.submit("company", "lab1", "temperature too high")
+        await dispatcher.stop(drain_timeout=10)
+    return dispatcher, line_stub.app.state.calls, dead_letters.docs
+
+def test_large_audience_is_split_into_multicast_batches():
+    dispatcher, calls, dead = asyncio.run(dispatch(1201))
+    assert sorted(len(call["body"]["to"]) for call in calls) == [201, 500, 500]
+    assert all(call["status"] == 200 for call in calls)
+    assert dispatcher.stats["sent"] == 1201
+    assert not dead
+
+def test_429_pauses_the_bucket_then_retries_with_same_key():
+    started = time.monotonic()
+    dispatcher, calls, dead = asyncio.run(dispatch(3, failures=[(429, 1)]))
+    # Retry-After: 1 讓 bucket 暫停至少 1 秒
+    assert time.monotonic() - started >= 1
+    assert [call["status"] for call in calls] == [429, 200]
+    assert calls[0]["retry_key"] == calls[1]["retry_key"]
+    assert dispatcher.stats["throttled"] == 1 and dispatcher.stats["sent"] == 3
+    assert not dead
+
+def test_exhausted_retries_go_to_dead_letter(monkeypatch):
+    monkeypatch.setattr(alert_dispatcher, "ALERT_BACKOFF_SECONDS", 0.01)
+    dispatcher, calls, dead = asyncio.run(dispatch(2, failures=[(500, 10)], max_retries=2))
+    assert [call["status"] for call in calls] == [500, 500, 500]
+    assert dispatcher.stats["dead_letter"] == 1 and dispatcher.stats["sent"] == 0
+    assert dead[0]["line_user_ids"] == ["U0", "U1"]
+    assert dead[0]["error"].startswith("500")
+
+def test_bucket_pause_delays_every_waiter():
+    async def run():
+        bucket = TokenBucket(rate=100, capacity=5)
+        bucket.pause(0.2)
+        started = time.monotonic()
+        await asyncio.gather(bucket.acquire(), bucket.acquire())
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) >= 0.2
@@ -0,0 +1,36 @@
+from alert_state import AlertStateTracker
+
+THRESHOLDS = {"temp": {"max": 50}, "hum": {"min": 10}}
+
+def test_machines_in_one_frame_keep_separate_state():
+    tracker = AlertStateTracker(hysteresis_ratio=0.1)
+    fired, _ = tracker.evaluate("c_l", "s1", "m1", {"temp": 60}, THRESHOLDS)
+    assert list(fired) == ["temp"]
+    # 同一批次的另一台機台正常，不能把 m1 的狀態清掉
+    for _ in range(3):
+        fired_m2, recovered_m2 = tracker.evaluate("c_l", "s1", "m2", {"temp": 20}, THRESHOLDS)
+        fired_m1, recovered_m1 = tracker.evaluate("c_l", "s1", "m1", {"temp": 61}, THRESHOLDS)
+        assert not fired_m1 and not recovered_m1
+        assert not fired_m2 and not recovered_m2
+
+    # 在 hysteresis 區間內還不算恢復
+    assert tracker.evaluate("c_l", "s1", "m1", {"temp": 48}, THRESHOLDS) == ({}, {})
+    _, recovered = tracker.evaluate("c_l", "s1", "m1", {"temp": 44}, THRESHOLDS)
+    assert list(recovered) == ["temp"]
+    assert not tracker.states
+
+def test_removed_threshold_drops_state():
+    tracker = AlertStateTracker()
+    tracker.evaluate("c_l", "s1", "m1", {"temp": 60, "hum": 5}, THRESHOLDS)
+    assert set(tracker.states[("c_l", "s1", "m1")]) == {"temp", "hum"}
+
+    # temp 的門檻被移除：就算這筆資料沒有 temp 也要丟掉舊狀態
+    tracker.evaluate("c_l", "s1", "m1", {"hum": 5}, {"hum": {"min": 10}})
+    assert set(tracker.states[("c_l", "s1", "m1")]) == {"hum"}
+
+    # 之後重新設定門檻，應該重新通知一次
+    fired, _ = tracker.evaluate("c_l", "s1", "m1", {"temp": 60, "hum": 5}, THRESHOLDS)
+    assert list(fired) == ["temp"]
+
+    tracker.clear("c_l", "s1")
+    assert not tracker.states
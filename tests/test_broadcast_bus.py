@@ -0,0 +1,69 @@
+import asyncio
+import os
+import stat
+import time
+from broadcast_bus import UnixSocketBus, run_broker
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def test_broker_socket_is_private_and_relays(tmp_path):
+    path = str(tmp_path / "bus.sock")
+
+    async def run():
+        broker = asyncio.create_task(run_broker(path))
+        await wait_for(lambda: os.path.exists(path))
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+
+        received = []
+        publisher, subscriber = UnixSocketBus(path), UnixSocketBus(path)
+        await publisher.start(lambda channel, text: None)
+        await subscriber.start(lambda channel, text: received.append((channel, text)))
+        await wait_for(lambda: publisher.writer is not None and subscriber.writer is not None)
+        subscriber.subscribe("lab_a")
+        await asyncio.sleep(0.05)
+        await publisher.publish("lab_a", '{"v":1}')
+        await publisher.publish("lab_b", '{"v":2}')
+        await wait_for(lambda: received)
+        await asyncio.sleep(0.05)
+
+        await publisher.stop()
+        await subscriber.stop()
+        broker.cancel()
+        await asyncio.gather(broker, return_exceptions=True)
+        return mode, received
+
+    mode, received = asyncio.run(run())
+    assert mode == 0o600
+    assert received == [("lab_a", '{"v":1}')]
+
+def test_stalled_broker_does_not_block_publish(tmp_path):
+    path = str(tmp_path / "stalled.sock")
+
+    async def run():
+        # broker 接受連線後完全不讀，socket buffer 很快就滿
+        stalled = []
+        server = await asyncio.start_unix_server(lambda r, w: stalled.append(w), path)
+        bus = UnixSocketBus(path, queue_size=100)
+        await bus.start(lambda channel, text: None)
+        await wait_for(lambda: bus.writer is not None)
+
+        payload = "x" * 4096
+        started = time.perf_counter()
+        for _ in range(5000):
+            await bus.publish("lab_a", payload)
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0.2)
+
+        stats = dict(bus.stats)
+        await bus.stop()
+        server.close()
+        return elapsed, stats, bus.queue.qsize()
+
+    elapsed, stats, queued = asyncio.run(run())
+    assert elapsed < 1
+    assert stats["dropped"] > 0
+    assert queued <= 100
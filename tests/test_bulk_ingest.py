@@ -0,0 +1,110 @@
+import asyncio
+import gzip
+from datetime import datetime
+from typing import Union
+import pytest
+from pydantic import BaseModel, Field, AliasChoices
+from pymongo.errors import BulkWriteError
+import bulk_ingest
+from bulk_ingest import BulkIngest, iter_ndjson_lines, parse_line
+
+class Reading(BaseModel):
+    machine: str
+    timestamp: Union[str, int, float]
+    values: dict = Field(validation_alias=AliasChoices("values", "value"))
+
+async def chunked(data: bytes, size: int = 7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+async def collect(data: bytes, compressed: bool):
+    return [item async for item in iter_ndjson_lines(chunked(data), compressed)]
+
+class FakeCollection:
+    def __init__(self, error=None):
+        self.error = error
+        self.docs = []
+
+    async def insert_many(self, docs, ordered=True):
+        if self.error:
+            raise self.error
+        self.docs.extend(docs)
+
+class FakeRollup:
+    def __init__(self):
+        self.added = []
+        self.gaps = []
+
+    def add(self, company_lab, machine, timestamp, values):
+        self.added.append(timestamp)
+
+    def add_gap(self, company_lab, machine, first, last):
+        self.gaps.append((machine, first, last))
+
+def rows(count: int):
+    return [(i + 1, parse_line(f'{{"machine": "m1", "timestamp": "2025-01-01 00:00:0{i}", "values": {{"t": {i}}}}}'.encode(), Reading))
+            for i in range(count)]
+
+def test_multi_member_gzip_and_blank_lines():
+    data = gzip.compress(b'{"a": 1}\n\n{"a": 2}\n') + gzip.compress(b'{"a": 3}')
+    lines = asyncio.run(collect(data, compressed=True))
+    assert lines == [(1, b'{"a": 1}'), (3, b'{"a": 2}'), (4, b'{"a": 3}')]
+
+def test_truncated_gzip_and_long_line_are_rejected(monkeypatch):
+    with pytest.raises(ValueError):
+        asyncio.run(collect(gzip.compress(b'{"a": 1}\n')[:-6], compressed=True))
+    monkeypatch.setattr(bulk_ingest, "BULK_INGEST_MAX_LINE", 16)
+    with pytest.raises(ValueError, match="第 2 行"):
+        asyncio.run(collect(b'{"a": 1}\n' + b"x" * 40, compressed=False))
+
+def test_parse_line_is_strict_and_deterministic():
+    line = b'{"machine": "m1", "timestamp": 1735689600, "value": {"t": 1}}'
+    doc = parse_line(line, Reading)
+    assert doc["timestamp"] == datetime(2025, 1, 1)
+    assert doc["values"] == {"t": 1}
+    # 重傳同一行得到同一個 _id，時間部分和 timestamp 一致
+    assert parse_line(line, Reading)["_id"] == doc["_id"]
+    assert doc["_id"].generation_time.replace(tzinfo=None) == datetime(2025, 1, 1)
+    assert parse_line(line.replace(b'"t": 1', b'"t": 2'), Reading)["_id"] != doc["_id"]
+
+    with pytest.raises(ValueError, match="timestamp"):
+        parse_line(b'{"machine": "m1", "timestamp": "yesterday", "values": {}}', Reading)
+    with pytest.raises(ValueError):
+        parse_line(b'{"timestamp": 1735689600, "values": {}}', Reading)
+
+def test_bulk_write_errors_map_to_line_numbers():
+    error = BulkWriteError({"writeErrors": [
+        {"index": 1, "code": 121, "errmsg": "validation failed"},
+        {"index": 2, "code": 11000, "errmsg": "duplicate key"},
+    ]})
+    db = {"lab_a-m1-2025-1": FakeCollection(error)}
+    rollup = FakeRollup()
+    job = BulkIngest(db, rollup_writer=rollup)
+
+    async def run():
+        for line_no, doc in rows(3):
+            await job.add("lab_a", line_no, doc)
+        return await job.finish("lab_a")
+
+    report = asyncio.run(run())
+    assert report["accepted"] == 1
+    assert report["duplicates"] == 1
+    assert report["rejected"] == 1
+    assert report["errors"] == [{"line": 2, "error": "validation failed"}]
+    # 只有這次真的寫入的才算進 rollup
+    assert rollup.added == [datetime(2025, 1, 1, 0, 0, 0)]
+
+def test_uncertain_failure_rejects_all_and_marks_rollup_gap():
+    db = {"lab_a-m1-2025-1": FakeCollection(TimeoutError("timed out"))}
+    rollup = FakeRollup()
+    job = BulkIngest(db, rollup_writer=rollup)
+
+    async def run():
+        for line_no, doc in rows(3):
+            await job.add("lab_a", line_no, doc)
+        return await job.finish("lab_a")
+
+    report = asyncio.run(run())
+    assert report["accepted"] == 0 and report["rejected"] == 3
+    assert rollup.added == []
+    assert rollup.gaps == [("m1", datetime(2025, 1, 1, 0, 0, 0), datetime(2025, 1, 1, 0, 0, 2))]
@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime
+from collection_catalog import CollectionCatalog
+
+class FakeDB:
+    def __init__(self, names):
+        self.names = set(names)
+        self.lookups = []
+
+    async def list_collection_names(self, filter=None):
+        if filter is None:
+            return list(self.names)
+        self.lookups.append(filter["name"])
+        return [name for name in self.names if name == filter["name"]]
+
+def test_recent_month_miss_checks_database():
+    now = datetime.utcnow()
+    this_month = f"lab_a-m1-{now.year}-{now.month}"
+    old_month = "lab_a-m1-2001-1"
+
+    async def run():
+        db = FakeDB([old_month])
+        catalog = CollectionCatalog(db, refresh_seconds=0)
+        await catalog.load()
+        # 目錄載入後才由別的 worker 建立
+        db.names.add(this_month)
+        found = await catalog.exists(this_month)
+        again = await catalog.exists(this_month)
+        missing_old = await catalog.exists("lab_a-m1-2001-2")
+        return found, again, missing_old, db.lookups
+
+    found, again, missing_old, lookups = asyncio.run(run())
+    assert found and again
+    assert not missing_old
+    # 找到後加入目錄，舊月份不查 DB
+    assert lookups == [this_month]
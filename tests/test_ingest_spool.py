@@ -0,0 +1,76 @@
+import asyncio
+import os
+import ingest_spool
+from ingest_spool import IngestSpool, SEGMENT_SUFFIX
+
+class Sink:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.docs = []
+
+    async def __call__(self, collection_name, docs):
+        if self.fail:
+            raise ConnectionError("mongo down")
+        self.docs.extend((collection_name, doc["_id"]) for doc in docs)
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+async def run_spool(directory, sink, docs=None, until=None):
+    spool = IngestSpool(str(directory), replay_batch=2)
+    spool.start(sink)
+    await wait_for(lambda: spool.directory is not None)
+    if docs:
+        assert spool.put("lab-m1-2025-1", docs)
+        await wait_for(lambda: spool.stats["spooled"] == len(docs))
+    if until:
+        await wait_for(lambda: until(spool))
+    await spool.stop()
+    return spool
+
+def segments(directory):
+    return sorted(name for name in os.listdir(os.path.join(directory, "0")) if name.endswith(SEGMENT_SUFFIX))
+
+def test_replays_exactly_once_after_reopen(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_spool, "SPOOL_RETRY_SECONDS", 0)
+    docs = [{"_id": i, "value": i} for i in range(5)]
+
+    async def run():
+        # DB 掛掉時寫進 spool，補寫一直失敗
+        failing = Sink(fail=True)
+        await run_spool(tmp_path, failing, docs)
+
+        # 重啟後 DB 恢復：從 offset 接著補寫完
+        sink = Sink()
+        await run_spool(tmp_path, sink, until=lambda s: s.stats["depth_bytes"] == 0)
+
+        # 再重啟一次不會重送，也不會留下空的 segment
+        again = Sink()
+        await run_spool(tmp_path, again)
+        await run_spool(tmp_path, again)
+        return sink.docs, again.docs
+
+    replayed, replayed_again = asyncio.run(run())
+    assert replayed == [("lab-m1-2025-1", i) for i in range(5)]
+    assert replayed_again == []
+    assert len(segments(tmp_path)) == 1
+
+def test_torn_tail_is_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_spool, "SPOOL_RETRY_SECONDS", 0)
+    docs = [{"_id": i} for i in range(3)]
+
+    async def run():
+        await run_spool(tmp_path, Sink(fail=True), docs)
+        # 模擬寫到一半當機：segment 尾端留下半筆紀錄
+        with open(os.path.join(tmp_path, "0", segments(tmp_path)[-1]), "ab") as f:
+            f.write(b"\x40\x00\x00\x00\x01")
+        sink = Sink()
+        spool = await run_spool(tmp_path, sink, until=lambda s: s.stats["depth_bytes"] == 0)
+        return sink.docs, spool.stats["corrupted"]
+
+    replayed, corrupted = asyncio.run(run())
+    assert [doc_id for _, doc_id in replayed] == [0, 1, 2]
+    assert corrupted == 1
@@ -0,0 +1,20 @@
+import asyncio
+from line_webhook import WebhookProcessor
+
+def event(event_id: str):
+    return {"webhookEventId": event_id, "type": "follow"}
+
+def test_dropped_event_is_accepted_on_redelivery():
+    async def run():
+        processor = WebhookProcessor(None, None, queue_size=1)
+        first = processor.submit([event("a"), event("b")])
+        processor.queue.get_nowait()
+        # LINE 重送同一批：a 已排入過要略過，b 這次要能排入
+        second = processor.submit([event("a"), event("b")])
+        return first, second, processor.queue.get_nowait(), processor.stats
+
+    first, second, queued, stats = asyncio.run(run())
+    assert first == 1
+    assert second == 0
+    assert queued["webhookEventId"] == "b"
+    assert stats["duplicates"] == 1 and stats["dropped"] == 1
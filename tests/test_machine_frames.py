@@ -0,0 +1,63 @@
+import json
+from datetime import datetime, timedelta, timezone
+import pytest
+from machine_frames import decode_frame, negotiate_format, parse_timestamp, DECODERS
+
+READING = {"machine": "m1", "timestamp": "2025-01-01 08:00:00", "values": {"t": 21.5, "on": True}}
+EXPECTED = [{"machine": "m1", "timestamp": datetime(2025, 1, 1, 8), "values": {"t": 21.5, "on": True}}]
+
+def test_json_single_and_batched_frames():
+    assert decode_frame("json", json.dumps(READING)) == EXPECTED
+    batch = {"machine": "m1", "readings": [
+        {"timestamp": 1735718400, "values": {"t": 1}},
+        {"machine": "m2", "timestamp": 1735718400000, "values": {"t": 2}},
+        {"timestamp": 1735718400},
+        "not a reading",
+    ]}
+    decoded = decode_frame("json", json.dumps(batch).encode())
+    assert [(r["machine"], r["timestamp"], r["values"]) for r in decoded] == [
+        ("m1", datetime(2025, 1, 1, 8), {"t": 1}),
+        # 單筆的 machine 優先，毫秒 epoch 也能解析
+        ("m2", datetime(2025, 1, 1, 8), {"t": 2}),
+        ("m1", datetime(2025, 1, 1, 8), {}),
+    ]
+
+def test_batch_without_machine_is_skipped_and_size_is_limited(monkeypatch):
+    assert decode_frame("json", json.dumps({"readings": [{"timestamp": 0, "values": {}}]})) == []
+    with pytest.raises(ValueError):
+        decode_frame("json", json.dumps({"machine": "m1", "readings": {"t": 1}}))
+    import machine_frames
+    monkeypatch.setattr(machine_frames, "FRAME_MAX_READINGS", 2)
+    with pytest.raises(ValueError):
+        decode_frame("json", json.dumps([READING] * 3))
+
+def test_msgpack_round_trip():
+    msgpack = pytest.importorskip("msgpack")
+    assert decode_frame("msgpack", msgpack.packb(READING)) == EXPECTED
+    # 原生 timestamp extension 直接變成 UTC datetime
+    native = dict(READING, timestamp=datetime(2025, 1, 1, 16, tzinfo=timezone(timedelta(hours=8))))
+    assert decode_frame("msgpack", msgpack.packb(native, datetime=True)) == EXPECTED
+
+def test_cbor_round_trip():
+    cbor2 = pytest.importorskip("cbor2")
+    assert decode_frame("cbor", cbor2.dumps(READING)) == EXPECTED
+    native = dict(READING, timestamp=datetime(2025, 1, 1, 8, tzinfo=timezone.utc))
+    assert decode_frame("cbor", cbor2.dumps({"machine": "m1", "readings": [native]})) == EXPECTED
+
+def test_strict_and_lenient_timestamps():
+    assert parse_timestamp("2025-01-01T16:00:00+08:00") == datetime(2025, 1, 1, 8)
+    assert parse_timestamp(1735718400.5) == datetime(2025, 1, 1, 8, 0, 0, 500000)
+    for bad in ("yesterday", None, "", True, 1e30):
+        with pytest.raises(ValueError):
+            parse_timestamp(bad, strict=True)
+        # 非 strict 時用現在時間
+        assert abs(parse_timestamp(bad) - datetime.utcnow()) < timedelta(seconds=5)
+
+def test_negotiation_falls_back_to_json():
+    assert negotiate_format(None, []) == ("json", None)
+    assert negotiate_format(None, ["iot.unknown", "chat"]) == ("json", None)
+    assert negotiate_format("xml", []) == (None, None)
+    assert negotiate_format("json", ["iot.json"]) == ("json", None)
+    if "msgpack" in DECODERS:
+        assert negotiate_format(None, ["iot.unknown", "iot.msgpack"]) == ("msgpack", "iot.msgpack")
+        assert negotiate_format("msgpack", []) == ("msgpack", None)
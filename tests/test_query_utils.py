@@ -0,0 +1,62 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+import pytest
+import query_utils
+from query_utils import merge_sorted_cursors
+
+class FakeCursor:
+    def __init__(self, docs, fail_after=None):
+        self.docs = docs
+        self.fail_after = fail_after
+        self.read = 0
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for doc in self.docs:
+            if self.fail_after is not None and self.read >= self.fail_after:
+                raise RuntimeError("cursor failed")
+            self.read += 1
+            await asyncio.sleep(0)
+            yield doc
+
+def make_docs(month: int, count: int):
+    start = datetime(2025, month, 1)
+    return [{"timestamp": start + timedelta(seconds=random.randint(0, 86400 * 40)), "month": month} for _ in range(count)]
+
+async def collect(cursors):
+    return [doc async for doc in merge_sorted_cursors(cursors)]
+
+def test_merge_orders_across_batches(monkeypatch):
+    # 批次小一點才會跨好幾個 batch
+    monkeypatch.setattr(query_utils, "SEARCH_BATCH_SIZE", 7)
+    sources = [sorted(make_docs(m, n), key=lambda d: d["timestamp"]) for m, n in ((1, 50), (2, 0), (3, 23), (4, 1))]
+    merged = asyncio.run(collect([FakeCursor(docs) for docs in sources]))
+
+    assert len(merged) == 74
+    assert [d["timestamp"] for d in merged] == sorted(d["timestamp"] for docs in sources for d in docs)
+
+def test_merge_propagates_cursor_errors(monkeypatch):
+    monkeypatch.setattr(query_utils, "SEARCH_BATCH_SIZE", 5)
+    docs = sorted(make_docs(1, 20), key=lambda d: d["timestamp"])
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect([FakeCursor(docs), FakeCursor(docs, fail_after=12)]))
+
+def test_merge_cancels_pumps_when_closed_early(monkeypatch):
+    monkeypatch.setattr(query_utils, "SEARCH_BATCH_SIZE", 5)
+    cursor = FakeCursor(sorted(make_docs(1, 1000), key=lambda d: d["timestamp"]))
+
+    async def take_three():
+        merged = merge_sorted_cursors([cursor], prefetch=1)
+        docs = [await anext(merged) for _ in range(3)]
+        await merged.aclose()
+        read = cursor.read
+        await asyncio.sleep(0.01)
+        return docs, read
+
+    docs, read = asyncio.run(take_three())
+    assert len(docs) == 3
+    # 關閉後 pump 不會繼續讀 cursor
+    assert cursor.read == read < 1000
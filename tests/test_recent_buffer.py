@@ -0,0 +1,75 @@
+import asyncio
+import gc
+from datetime import datetime, timedelta
+from bson import ObjectId
+from recent_buffer import MachineRing, RecentBuffer
+
+def make_doc(i: int, values=None):
+    return {
+        "_id": ObjectId(),
+        "timestamp": datetime(2025, 1, 1) + timedelta(seconds=i),
+        "machine": "m1",
+        "values": values if values is not None else {"t": i, "f": i + 0.5}
+    }
+
+def test_ring_wraps_and_keeps_types():
+    ring = MachineRing("m1", 5)
+    ring.load([])
+    docs = [make_doc(i) for i in range(8)]
+    docs[6]["values"] = {"t": 6, "status": "ok"}
+    for doc in docs:
+        ring.append(doc)
+
+    latest = ring.latest(10)
+    assert [d["timestamp"] for d in latest] == [d["timestamp"] for d in docs[3:]]
+    assert [d["_id"] for d in latest] == [str(d["_id"]) for d in docs[3:]]
+    assert latest[0]["values"] == {"t": 3, "f": 3.5}
+    assert isinstance(latest[0]["values"]["t"], int)
+    # 覆寫後舊位置的欄位不能殘留
+    assert latest[3]["values"] == {"t": 6, "status": "ok"}
+
+def test_load_merges_history_with_pending():
+    ring = MachineRing("m1", 4)
+    history = [make_doc(i) for i in range(3)]
+    live = [make_doc(i) for i in range(3, 5)]
+    # 預載期間收到的資料，其中一筆 DB 也查到了
+    for doc in [history[2]] + live:
+        ring.append(doc)
+    assert not ring.ready
+
+    ring.load(list(reversed(history)))
+    assert ring.ready and ring.complete
+    assert [d["values"]["t"] for d in ring.latest(4)] == [1, 2, 3, 4]
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, length=None):
+        await asyncio.sleep(0.01)
+        return self.docs
+
+class FakeDB:
+    def __getitem__(self, name):
+        return self
+
+    def find(self):
+        return FakeCursor([make_doc(0)])
+
+def test_preload_survives_gc_and_becomes_ready():
+    async def run():
+        buffer = RecentBuffer(FakeDB(), capacity=10)
+        buffer.append("c_l", "m1", make_doc(1))
+        gc.collect()
+        await asyncio.sleep(0.05)
+        return buffer.get("c_l", "m1", 2)
+
+    result = asyncio.run(run())
+    assert [d["values"]["t"] for d in result] == [0, 1]
@@ -0,0 +1,125 @@
+import asyncio
+import socket
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import pytest
+from pymongo.errors import BulkWriteError
+from bench.fake_motor import FakeDatabase
+from rollup import RollupWriter, backfill, ROLLUP_GAPS_COLLECTION, ROLLUP_STATE_COLLECTION, ROLLUP_WRITERS_COLLECTION
+
+class FakeCollection:
+    def __init__(self):
+        self.requests = []
+        self.docs = []
+        self.fail = None
+
+    async def bulk_write(self, requests, ordered=True):
+        if self.fail:
+            error, self.fail = self.fail, None
+            raise error
+        self.requests.extend(requests)
+        return SimpleNamespace()
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    async def find_one(self, query, *args, **kwargs):
+        if "start" in query:
+            # gap 重疊查詢
+            for gap in self.docs:
+                if gap["start"] <= query["start"]["$lte"] and gap["end"] > query["end"]["$gt"]:
+                    return gap
+            return None
+        state = None
+        for request in self.requests:
+            if request._filter == query:
+                if state is None:
+                    state = dict(request._doc["$setOnInsert"])
+                state["flushed"] = max(state.get("flushed", datetime.min), request._doc["$max"]["flushed"])
+        return state
+
+class FakeDB(dict):
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+def counted(collection):
+    return sum(request._doc["$inc"]["count"] for request in collection.requests)
+
+def test_failed_flush_is_retried_not_lost():
+    db = FakeDB()
+    writer = RollupWriter(db)
+    writer.add("c_l", "m1", datetime(2025, 1, 1, 10, 0, 5), {"t": 1})
+    writer.add("c_l", "m1", datetime(2025, 1, 1, 10, 0, 6), {"t": 3})
+
+    db["rollup_1m"].fail = BulkWriteError({"writeErrors": [{"index": 0, "code": 1}]})
+    asyncio.run(writer.flush())
+    assert counted(db["rollup_1m"]) == 0
+    # 1m 失敗時不推進 flushed
+    assert not db[ROLLUP_STATE_COLLECTION].requests
+
+    writer.add("c_l", "m1", datetime(2025, 1, 1, 10, 0, 7), {"t": 2})
+    asyncio.run(writer.flush())
+    assert counted(db["rollup_1m"]) == 3
+    assert counted(db["rollup_1h"]) == 3
+    # 已知失敗的那幾筆會重試，不算 gap
+    assert writer.stats["gaps"] == 0
+
+def test_uncertain_failure_records_gap_and_blocks_rollup():
+    db = FakeDB()
+    writer = RollupWriter(db)
+    writer.add("c_l", "m1", datetime(2025, 1, 1, 10, 30), {"t": 1})
+    db["rollup_1h"].fail = ConnectionError("down")
+    asyncio.run(writer.flush())
+    assert writer.gaps and writer.gaps[0]["start"] == datetime(2025, 1, 1, 10)
+
+    writer.add("c_l", "m1", datetime(2025, 1, 1, 13, 30), {"t": 1})
+    asyncio.run(writer.flush())
+    assert db[ROLLUP_GAPS_COLLECTION].docs
+
+    covers = lambda start, end: asyncio.run(writer.covers("c_l", "m1", start, end, "1h"))
+    # 第一次看到的小時之前、gap、尚未 flush 完的 bucket 都不能用 rollup
+    assert not covers(datetime(2025, 1, 1, 9), datetime(2025, 1, 1, 9, 59, 59))
+    assert not covers(datetime(2025, 1, 1, 10), datetime(2025, 1, 1, 11, 59, 59))
+    assert not covers(datetime(2025, 1, 1, 11), datetime(2025, 1, 1, 13, 59, 59))
+    assert covers(datetime(2025, 1, 1, 11), datetime(2025, 1, 1, 12, 59, 59))
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+def test_crashed_writer_records_gap_and_blocks_backfill():
+    now = datetime.utcnow()
+    flushed = now - timedelta(minutes=3)
+    db = FakeDatabase("test")
+
+    async def run():
+        await db[ROLLUP_STATE_COLLECTION].insert_one({"company_lab": "c_l", "machine": "m1", "start": now - timedelta(days=1), "flushed": flushed})
+        # 同一台主機上已經結束的 process (heartbeat 還很新)，以及另一台主機上還活著的 server
+        await db[ROLLUP_WRITERS_COLLECTION].insert_one({"_id": "crashed", "host": socket.gethostname(), "pid": dead_pid(),
+                                                        "heartbeat": now, "synced": now - timedelta(minutes=10)})
+        await db[ROLLUP_WRITERS_COLLECTION].insert_one({"_id": "live", "host": "other-host", "pid": 1,
+                                                        "heartbeat": now, "synced": now})
+        writer = RollupWriter(db)
+        writer.start()
+        await asyncio.sleep(0.05)
+        registered = sorted(w["_id"] for w in db[ROLLUP_WRITERS_COLLECTION].docs)
+
+        with pytest.raises(RuntimeError):
+            await backfill(db)
+
+        await writer.stop()
+        remaining = [w["_id"] for w in db[ROLLUP_WRITERS_COLLECTION].docs]
+        return writer.writer_id, registered, remaining, db[ROLLUP_GAPS_COLLECTION].docs
+
+    writer_id, registered, remaining, gaps = asyncio.run(run())
+    assert registered == sorted(["live", writer_id])
+    # 正常關機會刪掉自己的登記
+    assert remaining == ["live"]
+    assert len(gaps) == 1
+    assert gaps[0]["machine"] == "m1"
+    assert gaps[0]["start"] == (now - timedelta(minutes=10)).replace(second=0, microsecond=0)
+    assert gaps[0]["end"] >= now
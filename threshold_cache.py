@@ -0,0 +1,58 @@
+import asyncio
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+THRESHOLD_CACHE_TTL = int(os.getenv("THRESHOLD_CACHE_TTL", "60"))
+
+#門檻值快取：(company, lab, sensor) -> threshold，啟動時載入一次，之後由 API 更新
+#ttl > 0 時背景定期重新載入，讓其他 process 的修改也能生效
+class ThresholdCache:
+    def __init__(self, collection, ttl: int = THRESHOLD_CACHE_TTL):
+        self.collection = collection
+        self.ttl = ttl
+        self.thresholds: Dict[Tuple[str, str, str], dict] = {}
+        self.loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def load(self):
+        result = {}
+        async for doc in self.collection.find({}, {"company": 1, "lab": 1, "sensor": 1, "threshold": 1}):
+            result[(doc["company"], doc["lab"], doc["sensor"])] = doc.get("threshold")
+        self.thresholds = result
+        self.loaded_at = time.monotonic()
+
+    def start(self):
+        if self.ttl > 0 and self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.load()
+            except Exception as e:
+                print(f"門檻值快取更新失敗: {e}")
+
+    async def get(self, company: str, lab: str, sensor: str) -> Optional[dict]:
+        if self.loaded_at is None:
+            async with self._lock:
+                if self.loaded_at is None:
+                    await self.load()
+        return self.thresholds.get((company, lab, sensor))
+
+    def set(self, company: str, lab: str, sensor: str, threshold: dict):
+        self.thresholds[(company, lab, sensor)] = threshold
+
+    def invalidate(self, company: str, lab: str, sensor: str):
+        self.thresholds.pop((company, lab, sensor), None)
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+
+#登入使用者的帳號資料快取 (LRU + TTL)
+#修改權限 / 刪除 / 新增帳號時由 API 主動清除；其他 process 的修改最多延遲 TTL 秒
+class UserCache:
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: int = USER_CACHE_TTL):
+        self.collection = None
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def bind(self, collection):
+        self.collection = collection
+
+    async def get(self, account: str) -> Optional[dict]:
+        entry = self.entries.get(account)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            self.entries.move_to_end(account)
+            self.stats["hits"] += 1
+            return entry[0]
+
+        self.stats["misses"] += 1
+        # 同一帳號同時多個請求只查一次 DB
+        future = self._inflight.get(account)
+        if future:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[account] = future
+        try:
+            doc = await self.collection.find_one({"account": account})
+            if doc is not None:
+                self.entries[account] = (doc, time.monotonic())
+                self.entries.move_to_end(account)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            future.set_result(doc)
+            return doc
+        except Exception as e:
+            future.set_exception(e)
+            # 沒有其他人在等時避免 "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(account, None)
+
+    def invalidate(self, account: str):
+        self.stats["invalidations"] += 1
+        self.entries.pop(account, None)
+
+user_cache = UserCache()